@@ -1,72 +1,93 @@
 import os
+import re
+from os import environ as _ENV
 from dataclasses import dataclass
-from dotenv import load_dotenv
 
 
-def _load_env_once() -> None:
-    # idempotent load
-    load_dotenv()
+_ENV_LOADED = False
 
+_ENV_LINE_RE = re.compile(r"^[ \t]*(?:export[ \t]+)?([A-Za-z_][A-Za-z0-9_]*)[ \t]*=[ \t]*(.*?)[ \t\r]*$", re.M)
+_ENV_INLINE_COMMENT_RE = re.compile(r"\s+#")
 
-def get_bot_token() -> str:
-    _load_env_once()
-    token = os.getenv("BOT_TOKEN", "").strip()
-    if not token:
-        raise RuntimeError(
-            "BOT_TOKEN is not set. Create .env with BOT_TOKEN=... or set env variable."
-        )
-    return token
 
+def _find_dotenv() -> str | None:
+    # Same lookup as python-dotenv: walk up from this package's directory
+    path = os.path.dirname(os.path.abspath(__file__))
+    while True:
+        candidate = os.path.join(path, ".env")
+        if os.path.isfile(candidate):
+            return candidate
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
 
-@dataclass
-class UserbotConfig:
-    enabled: bool
-    api_id: int | None
-    api_hash: str | None
-    session_string: str | None
 
+def _fast_load_dotenv(path: str | None) -> None:
+    """Minimal .env loader: KEY=value lines, optional `export`, quotes and ` #` comments.
 
-def get_userbot_config() -> UserbotConfig:
-    _load_env_once()
-    enabled = (os.getenv("BYPASS_MODE", "userbot").strip().lower() == "userbot")
-    api_id = os.getenv("TG_API_ID")
-    api_hash = os.getenv("TG_API_HASH")
-    session_string = os.getenv("TG_SESSION_STRING")
-    return UserbotConfig(
-        enabled=enabled,
-        api_id=int(api_id) if (api_id and api_id.isdigit()) else None,
-        api_hash=api_hash if api_hash else None,
-        session_string=session_string if session_string else None,
-    )
+    Unlike python-dotenv it does not support ${VAR} expansion, escape
+    sequences or multi-line values. Existing environment variables win.
+    """
+    if not path:
+        return
+    try:
+        with open(path, encoding="utf-8") as fh:
+            src = fh.read()
+    except OSError:
+        return
+    for key, value in _ENV_LINE_RE.findall(src):
+        # A quoted value ends at its closing quote; anything after it (e.g. ` # comment`) is dropped
+        end = value.find(value[0], 1) if value[:1] in ("'", '"') else -1
+        if end != -1:
+            value = value[1:end]
+        else:
+            value = _ENV_INLINE_COMMENT_RE.split(value, 1)[0]
+        _ENV.setdefault(key, value)
 
 
-def get_bypass_mode() -> str:
-    _load_env_once()
-    # Only: off | userbot
-    mode = os.getenv("BYPASS_MODE", "userbot").strip().lower()
-    if mode not in {"off", "userbot"}:
-        mode = "userbot"
-    return mode
+def _load_env_once() -> None:
+    # .env is parsed only on the first call; later calls are a flag check
+    global _ENV_LOADED
+    if _ENV_LOADED:
+        return
+    _fast_load_dotenv(_find_dotenv())
+    _ENV_LOADED = True
 
 
-def get_ytdlp_cookies_file() -> str | None:
-    _load_env_once()
-    path = (os.getenv("YTDLP_COOKIES_FILE") or "").strip()
-    if path and os.path.exists(path):
-        return path
-    return None
+@dataclass
+class UserbotConfig:
+    enabled: bool
+    api_id: int | None
+    api_hash: str | None
+    session_string: str | None
 
 
-def get_ytdlp_cookies_from_browser() -> str | None:
-    _load_env_once()
-    # Examples: chrome | chromium | firefox | safari (platform dependent)
-    val = (os.getenv("YTDLP_COOKIES_FROM_BROWSER") or "").strip()
-    return val or None
+@dataclass(frozen=True, slots=True)
+class Settings:
+    """Snapshot of every environment-driven option, read once at import."""
+
+    bot_token: str
+    userbot: UserbotConfig
+    bypass_mode: str
+    ytdlp_cookies_file: str | None
+    ytdlp_cookies_from_browser: str | None
+    probe_concurrency: int
+    download_concurrency: int
+    metadata_cache_ttl: int
+    metadata_cache_size: int
+    metadata_cache_db: str | None
+    thread_pool_workers: int
+    ytdlp_fragment_concurrency: int
+    ytdlp_fragment_downloader: str | None
+    tmpfs_dir: str | None
+    max_active_jobs: int
+    max_chat_jobs: int
+    user_cooldown_seconds: int
 
 
 def _get_int_env(name: str, default: int, *, min_value: int | None = None, max_value: int | None = None) -> int:
-    _load_env_once()
-    raw = os.getenv(name)
+    raw = _ENV.get(name)
     if raw is None or not raw.strip():
         return default
     try:
@@ -80,45 +101,143 @@ def _get_int_env(name: str, default: int, *, min_value: int | None = None, max_v
     return value
 
 
+def _build_settings() -> Settings:
+    _load_env_once()
+    get = _ENV.get
+
+    # Only: off | userbot
+    raw_mode = get("BYPASS_MODE", "userbot").strip().lower()
+    bypass_mode = raw_mode if raw_mode in {"off", "userbot"} else "userbot"
+
+    api_id = get("TG_API_ID")
+    api_hash = get("TG_API_HASH")
+    session_string = get("TG_SESSION_STRING")
+    userbot = UserbotConfig(
+        enabled=(raw_mode == "userbot"),
+        api_id=int(api_id) if (api_id and api_id.isdigit()) else None,
+        api_hash=api_hash if api_hash else None,
+        session_string=session_string if session_string else None,
+    )
+
+    # RAM-backed scratch dir for downloads, e.g. /dev/shm
+    tmpfs_dir = (get("TMPFS_DIR") or "").strip()
+
+    cookies_file = (get("YTDLP_COOKIES_FILE") or "").strip()
+    # Examples: chrome | chromium | firefox | safari (platform dependent)
+    cookies_browser = (get("YTDLP_COOKIES_FROM_BROWSER") or "").strip()
+
+    probe_concurrency = _get_int_env("PROBE_CONCURRENCY", default=4, min_value=1)
+    download_concurrency = _get_int_env("DOWNLOAD_CONCURRENCY", default=6, min_value=1)
+
+    return Settings(
+        bot_token=get("BOT_TOKEN", "").strip(),
+        userbot=userbot,
+        bypass_mode=bypass_mode,
+        ytdlp_cookies_file=cookies_file if (cookies_file and os.path.exists(cookies_file)) else None,
+        ytdlp_cookies_from_browser=cookies_browser or None,
+        probe_concurrency=probe_concurrency,
+        download_concurrency=download_concurrency,
+        metadata_cache_ttl=_get_int_env("METADATA_CACHE_TTL", default=300, min_value=0),
+        metadata_cache_size=_get_int_env("METADATA_CACHE_SIZE", default=128, min_value=1),
+        metadata_cache_db=(get("METADATA_CACHE_DB") or "").strip() or None,
+        thread_pool_workers=_get_int_env(
+            "DL_THREAD_WORKERS",
+            default=max(8, probe_concurrency + download_concurrency),
+            min_value=2,
+            max_value=128,
+        ),
+        ytdlp_fragment_concurrency=_get_int_env("YTDLP_CONCURRENT_FRAGMENTS", default=8, min_value=1, max_value=32),
+        ytdlp_fragment_downloader=(get("YTDLP_FRAGMENT_DOWNLOADER") or "").strip() or None,
+        tmpfs_dir=tmpfs_dir if (tmpfs_dir and os.path.isdir(tmpfs_dir)) else None,
+        max_active_jobs=_get_int_env("MAX_ACTIVE_JOBS", default=12, min_value=0, max_value=128),
+        max_chat_jobs=_get_int_env("MAX_CHAT_JOBS", default=3, min_value=0, max_value=32),
+        user_cooldown_seconds=_get_int_env("USER_REQUEST_COOLDOWN", default=5, min_value=0, max_value=600),
+    )
+
+
+# Read once at import: downloader/handlers copy these values into module constants,
+# and YTDLP_COOKIES_FILE / TMPFS_DIR are checked for existence only here
+SETTINGS = _build_settings()
+
+
+def get_bot_token() -> str:
+    token = SETTINGS.bot_token
+    if not token:
+        raise RuntimeError(
+            "BOT_TOKEN is not set. Create .env with BOT_TOKEN=... or set env variable."
+        )
+    return token
+
+
+def get_userbot_config() -> UserbotConfig:
+    return SETTINGS.userbot
+
+
+def get_bypass_mode() -> str:
+    return SETTINGS.bypass_mode
+
+
+def get_ytdlp_cookies_file() -> str | None:
+    return SETTINGS.ytdlp_cookies_file
+
+
+def get_ytdlp_cookies_from_browser() -> str | None:
+    return SETTINGS.ytdlp_cookies_from_browser
+
+
 def get_probe_concurrency() -> int:
     """Maximum number of parallel metadata probes (yt-dlp extract_info)."""
-    return _get_int_env("PROBE_CONCURRENCY", default=4, min_value=1)
+    return SETTINGS.probe_concurrency
 
 
 def get_download_concurrency() -> int:
     """Maximum number of parallel downloads executed by yt-dlp."""
-    return _get_int_env("DOWNLOAD_CONCURRENCY", default=6, min_value=1)
+    return SETTINGS.download_concurrency
 
 
 def get_metadata_cache_ttl() -> int:
     """How long (seconds) to keep metadata from yt-dlp to avoid repeated probing."""
-    return _get_int_env("METADATA_CACHE_TTL", default=300, min_value=0)
+    return SETTINGS.metadata_cache_ttl
 
 
 def get_metadata_cache_size() -> int:
     """Cap metadata cache to prevent unbounded growth under high load."""
-    return _get_int_env("METADATA_CACHE_SIZE", default=128, min_value=1)
+    return SETTINGS.metadata_cache_size
+
+
+def get_metadata_cache_db() -> str | None:
+    """SQLite file that keeps probed metadata across restarts; None keeps the cache in memory only."""
+    return SETTINGS.metadata_cache_db
 
 
 def get_thread_pool_workers() -> int:
-    default = max(8, get_probe_concurrency() + get_download_concurrency())
-    return _get_int_env("DL_THREAD_WORKERS", default=default, min_value=2, max_value=128)
+    return SETTINGS.thread_pool_workers
 
 
 def get_ytdlp_fragment_concurrency() -> int:
-    return _get_int_env("YTDLP_CONCURRENT_FRAGMENTS", default=8, min_value=1, max_value=32)
+    return SETTINGS.ytdlp_fragment_concurrency
+
+
+def get_ytdlp_fragment_downloader() -> str | None:
+    """External downloader (e.g. aria2c) for HLS/DASH fragments; None keeps yt-dlp's native one."""
+    return SETTINGS.ytdlp_fragment_downloader
+
+
+def get_tmpfs_dir() -> str | None:
+    """RAM-backed directory for download scratch files; None uses the system temp dir."""
+    return SETTINGS.tmpfs_dir
 
 
 def get_max_active_jobs() -> int:
     """Hard cap on simultaneously scheduled downloads; 0 disables the limit."""
-    return _get_int_env("MAX_ACTIVE_JOBS", default=12, min_value=0, max_value=128)
+    return SETTINGS.max_active_jobs
 
 
 def get_max_chat_jobs() -> int:
     """Limit queued downloads per chat to prevent a single chat from hogging the queue."""
-    return _get_int_env("MAX_CHAT_JOBS", default=3, min_value=0, max_value=32)
+    return SETTINGS.max_chat_jobs
 
 
 def get_user_cooldown_seconds() -> int:
     """Delay between successive download requests from the same user."""
-    return _get_int_env("USER_REQUEST_COOLDOWN", default=5, min_value=0, max_value=600)
+    return SETTINGS.user_cooldown_seconds
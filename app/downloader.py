@@ -1,11 +1,15 @@
 import asyncio
+import copy
 import os
+import pickle
 import shutil
+import sqlite3
 import tempfile
 import threading
 import time
 from collections import OrderedDict
 from concurrent.futures import ThreadPoolExecutor
+from contextlib import suppress
 from dataclasses import dataclass
 from functools import partial
 from typing import Optional, Tuple, List, Dict, Callable
@@ -21,8 +25,11 @@ try:
         get_download_concurrency,
         get_metadata_cache_ttl,
         get_metadata_cache_size,
+        get_metadata_cache_db,
         get_thread_pool_workers,
         get_ytdlp_fragment_concurrency,
+        get_ytdlp_fragment_downloader,
+        get_tmpfs_dir,
     )  # type: ignore
 except Exception:  # pragma: no cover
     from config import (
@@ -32,8 +39,11 @@ except Exception:  # pragma: no cover
         get_download_concurrency,
         get_metadata_cache_ttl,
         get_metadata_cache_size,
+        get_metadata_cache_db,
         get_thread_pool_workers,
         get_ytdlp_fragment_concurrency,
+        get_ytdlp_fragment_downloader,
+        get_tmpfs_dir,
     )
 
 
@@ -51,47 +61,176 @@ _METADATA_CACHE_TTL = max(0, get_metadata_cache_ttl())
 _METADATA_CACHE_SIZE = max(1, get_metadata_cache_size())
 _FRAGMENT_CONCURRENCY = max(1, get_ytdlp_fragment_concurrency())
 
-_THREAD_POOL = ThreadPoolExecutor(
-    max_workers=get_thread_pool_workers(),
-    thread_name_prefix="ytbot",
+
+def _fragment_downloader_opts() -> Dict:
+    # Фрагментированные HLS/DASH можно отдать внешнему загрузчику (aria2c качает сегменты
+    # параллельно в своём процессе, без GIL); если бинарника нет — встроенный загрузчик yt-dlp
+    name = get_ytdlp_fragment_downloader()
+    if not name or not shutil.which(name):
+        return {}
+    return {"external_downloader": {"m3u8": name, "dash": name}}
+
+
+_FRAGMENT_DOWNLOADER_OPTS = _fragment_downloader_opts()
+
+_TMPFS_DIR = get_tmpfs_dir()
+
+# mp4 и m4a оставляем как есть (без прохода ffmpeg по файлу), остальные контейнеры
+# (webm, mkv, ...) перепаковываем в mp4. FFmpegVideoRemuxer копирует потоки (-c copy),
+# тогда как FFmpegVideoConvertor перекодирует их
+_MP4_CONVERT_MAPPING = "m4a>m4a/mp4"
+
+# Раздельные пулы: скачивание держит поток минутами (и может запускать ffmpeg),
+# а сетевые пробы метаданных не должны ждать освобождения этих потоков
+_PROBE_POOL = ThreadPoolExecutor(max_workers=_PROBE_CONCURRENCY, thread_name_prefix="ytbot-probe")
+_DOWNLOAD_POOL = ThreadPoolExecutor(
+    max_workers=max(get_thread_pool_workers(), _DOWNLOAD_CONCURRENCY),
+    thread_name_prefix="ytbot-dl",
 )
 
 _probe_semaphore = asyncio.Semaphore(_PROBE_CONCURRENCY)
 _download_semaphore = asyncio.Semaphore(_DOWNLOAD_CONCURRENCY)
 
-_MetadataEntry = Tuple[float, Optional[dict], Optional[str]]
+class _MetadataEntry:
+    """Запись кеша метаданных: момент истечения, (info, err) и флаг visited.
+
+    По флагу идёт вытеснение «вторым шансом» (CLOCK): популярные ссылки переживают
+    поток одноразовых, а попадание не перестраивает порядок.
+    """
+
+    __slots__ = ("deadline", "value", "visited")
+
+    def __init__(self, deadline: float, value: Tuple[Optional[dict], Optional[str]]) -> None:
+        self.deadline = deadline
+        self.value = value
+        self.visited = False
+
+
 _metadata_cache: "OrderedDict[str, _MetadataEntry]" = OrderedDict()
 _metadata_lock = threading.Lock()
+_metadata_inflight: Dict[str, "asyncio.Future[Tuple[Optional[dict], Optional[str]]]"] = {}
 
 
 def _metadata_cache_get(url: str) -> Tuple[Optional[dict], Optional[str]] | None:
     if _METADATA_CACHE_TTL <= 0:
         return None
-    now = time.time()
+    now = time.monotonic()
     with _metadata_lock:
         entry = _metadata_cache.get(url)
-        if not entry:
+        if entry is None:
             return None
-        ts, info, err = entry
-        if (now - ts) > _METADATA_CACHE_TTL:
-            _metadata_cache.pop(url, None)
+        if now > entry.deadline:
+            del _metadata_cache[url]
             return None
-        _metadata_cache.move_to_end(url)
-        return info, err
+        entry.visited = True
+    return entry.value
 
 
-def _metadata_cache_set(url: str, info: Optional[dict], err: Optional[str]) -> None:
+def _metadata_cache_evict(now: float) -> None:
+    # Вызывается под _metadata_lock перед вставкой: освобождает место под одну запись.
+    # Старейшая запись с флагом visited уходит в конец со сброшенным флагом;
+    # первая без флага (или просроченная) вытесняется
+    while len(_metadata_cache) >= _METADATA_CACHE_SIZE:
+        url, entry = _metadata_cache.popitem(last=False)
+        if entry.visited and now <= entry.deadline:
+            entry.visited = False
+            _metadata_cache[url] = entry
+
+
+def _metadata_cache_set(url: str, info: Optional[dict], err: Optional[str], ttl: Optional[float] = None) -> None:
+    # ttl — остаток срока, если запись пришла из кеша на диске; иначе полный TTL
     if _METADATA_CACHE_TTL <= 0:
         return
-    now = time.time()
+    now = time.monotonic()
+    entry = _MetadataEntry(now + (_METADATA_CACHE_TTL if ttl is None else ttl), (info, err))
     with _metadata_lock:
-        _metadata_cache[url] = (now, info, err)
-        _metadata_cache.move_to_end(url)
-        while len(_metadata_cache) > _METADATA_CACHE_SIZE:
-            _metadata_cache.popitem(last=False)
+        _metadata_cache.pop(url, None)
+        _metadata_cache_evict(now)
+        _metadata_cache[url] = entry
+
+
+class _DiskMetadataCache:
+    """Второй уровень кеша метаданных в SQLite: переживает перезапуск бота.
+
+    Используется только из потоков пула, поэтому event loop на диск не ходит.
+    Раз в ``_PRUNE_EVERY`` записей удаляет просроченное и держит не больше ``max_rows`` строк.
+    """
+
+    _PRUNE_EVERY = 256
+
+    def __init__(self, path: str, ttl: int, max_rows: int) -> None:
+        self._ttl = ttl
+        self._max_rows = max_rows
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS kv (url TEXT PRIMARY KEY, ts REAL NOT NULL, info BLOB, err TEXT)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS kv_ts ON kv (ts)")
+        with self._lock:
+            self._prune()
+
+    def _prune(self) -> None:
+        # Вызывается под self._lock
+        self._conn.execute("DELETE FROM kv WHERE ts < ?", (time.time() - self._ttl,))
+        self._conn.execute(
+            "DELETE FROM kv WHERE url IN (SELECT url FROM kv ORDER BY ts DESC LIMIT -1 OFFSET ?)",
+            (self._max_rows,),
+        )
+
+    def get(self, url: str) -> Tuple[Tuple[Optional[dict], Optional[str]], float] | None:
+        """((info, err), оставшийся TTL в секундах) или None."""
+        with self._lock:
+            row = self._conn.execute("SELECT ts, info, err FROM kv WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return None
+        ts, blob, err = row
+        remaining = self._ttl - (time.time() - ts)
+        if remaining <= 0:
+            return None
+        try:
+            info = pickle.loads(blob) if blob is not None else None
+        except Exception:  # noqa: BLE001
+            return None
+        return (info, err), remaining
+
+    def set(self, url: str, info: Optional[dict], err: Optional[str]) -> None:
+        try:
+            blob = pickle.dumps(info, protocol=5) if info is not None else None
+        except Exception:  # noqa: BLE001
+            return
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO kv (url, ts, info, err) VALUES (?, ?, ?, ?)",
+                (url, time.time(), blob, err),
+            )
+            self._writes += 1
+            if self._writes % self._PRUNE_EVERY == 0:
+                self._prune()
+
+
+# На диске держим заметно больше записей, чем в памяти, но не без предела
+_DISK_CACHE_ROWS_FACTOR = 16
+
+
+def _open_disk_metadata_cache() -> Optional[_DiskMetadataCache]:
+    path = get_metadata_cache_db()
+    if not path or _METADATA_CACHE_TTL <= 0:
+        return None
+    try:
+        return _DiskMetadataCache(path, _METADATA_CACHE_TTL, _METADATA_CACHE_SIZE * _DISK_CACHE_ROWS_FACTOR)
+    except sqlite3.Error:
+        return None
+
+
+_disk_metadata_cache = _open_disk_metadata_cache()
 
 
 async def _run_blocking_with_limit(
+    executor: ThreadPoolExecutor,
     semaphore: asyncio.Semaphore,
     func: Callable,
     *args,
@@ -99,13 +238,69 @@ async def _run_blocking_with_limit(
 ):
     loop = asyncio.get_running_loop()
     async with semaphore:
-        return await loop.run_in_executor(_THREAD_POOL, partial(func, *args, **kwargs))
+        return await loop.run_in_executor(executor, partial(func, *args, **kwargs))
+
+
+class _ProgressRelay:
+    """Передаёт прогресс из потока yt-dlp в event loop.
+
+    Хранится только последнее значение; один потребитель отдаёт его в callback
+    не чаще раза в ``interval`` секунд, без отдельной задачи на каждый тик.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, callback: Callable, interval: float = 0.5) -> None:
+        self._loop = loop
+        self._callback = callback
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._pending: Optional[tuple] = None
+        self._ready = asyncio.Event()
+        self._task = loop.create_task(self._drain())
+
+    def push(self, status: str, downloaded: int, total: Optional[int], speed: Optional[float], eta: Optional[float]) -> None:
+        # Вызывается из рабочего потока; будим loop только если слот был пуст
+        with self._lock:
+            wake = self._pending is None
+            self._pending = (status, downloaded, total, speed, eta)
+        if wake:
+            try:
+                self._loop.call_soon_threadsafe(self._ready.set)
+            except RuntimeError:
+                pass
+
+    def _take(self) -> Optional[tuple]:
+        with self._lock:
+            snapshot, self._pending = self._pending, None
+        return snapshot
+
+    async def _emit(self, snapshot: tuple) -> None:
+        try:
+            await self._callback(*snapshot)
+        except Exception:
+            pass
+
+    async def _drain(self) -> None:
+        while True:
+            await self._ready.wait()
+            self._ready.clear()
+            snapshot = self._take()
+            if snapshot is not None:
+                await self._emit(snapshot)
+            await asyncio.sleep(self._interval)
+
+    async def aclose(self) -> None:
+        self._task.cancel()
+        with suppress(asyncio.CancelledError):
+            await self._task
+        snapshot = self._take()
+        if snapshot is not None:
+            await self._emit(snapshot)
 
 
 @dataclass
 class DownloadResult:
     ok: bool
-    filepath: Optional[str]
+    filepath: Optional[str]  # задан только для реально существующего файла (см. _resolve_download_path)
     title: Optional[str]
     ext: Optional[str]
     filesize: Optional[int]
@@ -117,8 +312,9 @@ class DownloadResult:
     error: Optional[str] = None
 
 
-@dataclass
+@dataclass(slots=True)
 class FormatOption:
+    # slots: опции живут в хранилище токенов всё время жизни меню
     kind: str  # 'va' | 'v' | 'a'
     quality: str  # 'best' | '1080' | '720' | '480' | '360'
     est_size: Optional[int]  # bytes
@@ -139,44 +335,162 @@ class BasicInfo:
 
 def _format_limit_str(max_bytes: int) -> str:
     # yt-dlp понимает суффиксы, используем мегабайты
-    mb = max_bytes // (1024 * 1024)
-    return f"{mb}M"
+    return f"{max_bytes >> 20}M"
+
+
+class _ProgressHook:
+    """progress_hooks-обработчик yt-dlp: пересылает статус в on_progress."""
+
+    __slots__ = ("cb",)
+
+    def __init__(self, cb: Callable[[str, int, Optional[int], Optional[float], Optional[float]], None]) -> None:
+        self.cb = cb
+
+    def __call__(self, d: Dict) -> None:
+        cb = self.cb
+        status = d.get("status") or ""
+        if status == "downloading":
+            downloaded = int(d.get("downloaded_bytes") or 0)
+            total = d.get("total_bytes") or d.get("total_bytes_estimate")
+            speed = d.get("speed")
+            eta = d.get("eta")
+            cb(
+                "downloading",
+                downloaded,
+                int(total) if total else None,
+                float(speed) if speed else None,
+                float(eta) if eta else None,
+            )
+        elif status == "finished":
+            cb("finished", int(d.get("downloaded_bytes") or 0), int(d.get("total_bytes") or 0), None, None)
+
+
+def _make_temp_dir(probe_info: Optional[dict]) -> str:
+    # Фрагменты и склейку пишем в tmpfs, только если ожидаемый размер известен
+    # и места хватает с запасом на промежуточные файлы; иначе — обычный temp
+    if _TMPFS_DIR and isinstance(probe_info, dict):
+        expected = probe_info.get("filesize") or probe_info.get("filesize_approx")
+        if expected:
+            with suppress(OSError):
+                if shutil.disk_usage(_TMPFS_DIR).free > expected * 2:
+                    return tempfile.mkdtemp(prefix="dlyt_", dir=_TMPFS_DIR)
+    return tempfile.mkdtemp(prefix="dlyt_")
+
+
+def _resolve_download_path(ydl: "ytdlp.YoutubeDL", info: Optional[dict]) -> str:
+    # Итоговый путь (после склейки/постобработки) yt-dlp кладёт в requested_downloads;
+    # если его нет — путь однозначно вычисляется из outtmpl, без обхода папки
+    if isinstance(info, dict):
+        req = info.get("requested_downloads") or []
+        filepath = req[0].get("filepath") if req else None
+        if filepath and os.path.exists(filepath):
+            return filepath
+        filepath = ydl.prepare_filename(info)
+        if filepath and os.path.exists(filepath):
+            return filepath
+    raise RuntimeError("Downloaded file not found")
+
+
+def _cleanup_flat(path: str) -> None:
+    # Во временной папке обычно 1–3 файла без подкаталогов: scandir+unlink дешевле rmtree
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                os.unlink(entry.path)
+        os.rmdir(path)
+    except OSError:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+_IMAGE_EXTS = frozenset(("jpg", "jpeg", "png", "webp"))
 
 
 def _pick_kind(info: dict) -> str:
-    ext = (info.get("ext") or "").lower()
-    vcodec = (info.get("vcodec") or "").lower()
-    acodec = (info.get("acodec") or "").lower()
-    if ext in {"jpg", "jpeg", "png", "webp"}:
+    ext = info.get("ext")
+    if ext and ext.lower() in _IMAGE_EXTS:
         return "image"
-    if vcodec and vcodec != "none":
+    vcodec = info.get("vcodec")
+    if vcodec and vcodec.lower() != "none":
         return "video"
-    if acodec and acodec != "none":
+    acodec = info.get("acodec")
+    if acodec and acodec.lower() != "none":
         return "audio"
     return "document"
 
 
+def _cookies_opts() -> Dict:
+    cookies_file = get_ytdlp_cookies_file()
+    if cookies_file:
+        return {"cookiefile": cookies_file}
+    cookies_browser = get_ytdlp_cookies_from_browser()
+    if cookies_browser:
+        return {"cookiesfrombrowser": (cookies_browser,)}
+    return {}
+
+
+# Загрузка переиспользует info пробы (process_ie_result), поэтому проба должна идти
+# с теми же cookies — иначе пропадут форматы, доступные только авторизованным
+_PROBE_YDL_OPTS: Dict = {
+    "quiet": True,
+    "no_warnings": True,
+    "noplaylist": True,
+    "extract_flat": False,
+    **_cookies_opts(),
+}
+
+_ydl_local = threading.local()
+
+
+def _get_ydl(ydl_opts: Dict) -> "ytdlp.YoutubeDL":
+    # Один экземпляр YoutubeDL на поток и набор опций: реестр экстракторов строится один раз
+    pool = getattr(_ydl_local, "pool", None)
+    if pool is None:
+        pool = _ydl_local.pool = {}
+    key = repr(sorted(ydl_opts.items()))
+    ydl = pool.get(key)
+    if ydl is None:
+        ydl = pool[key] = ytdlp.YoutubeDL(dict(ydl_opts))
+    return ydl
+
+
 def _extract_info_uncached(url: str) -> Tuple[Optional[dict], Optional[str]]:
     try:
-        ydl_opts = {
-            "quiet": True,
-            "no_warnings": True,
-            "noplaylist": True,
-            "extract_flat": False,
-        }
-        with ytdlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=False)
-            return info, None
+        info = _get_ydl(_PROBE_YDL_OPTS).extract_info(url, download=False)
+        return info, None
     except Exception as e:  # noqa: BLE001
         return None, str(e)
 
 
+def _extract_info_persistent(url: str) -> Tuple[Tuple[Optional[dict], Optional[str]], Optional[float]]:
+    # Промах в памяти: сначала кеш на диске, затем yt-dlp с записью результата на диск.
+    # Второй элемент — остаток TTL записи с диска (None для свежей пробы)
+    disk = _disk_metadata_cache
+    if disk is None:
+        return _extract_info_uncached(url), None
+    try:
+        cached = disk.get(url)
+    except sqlite3.Error:
+        cached = None
+    if cached is not None:
+        return cached
+    info, err = _extract_info_uncached(url)
+    with suppress(sqlite3.Error):
+        disk.set(url, info, err)
+    return (info, err), None
+
+
 def _extract_info_sync(url: str) -> Tuple[Optional[dict], Optional[str]]:
     cached = _metadata_cache_get(url)
     if cached is not None:
         return cached
-    info, err = _extract_info_uncached(url)
-    _metadata_cache_set(url, info, err)
+    (info, err), ttl = _extract_info_persistent(url)
+    _metadata_cache_set(url, info, err, ttl)
+    return info, err
+
+
+async def _probe_and_cache(url: str) -> Tuple[Optional[dict], Optional[str]]:
+    (info, err), ttl = await _run_blocking_with_limit(_PROBE_POOL, _probe_semaphore, _extract_info_persistent, url)
+    _metadata_cache_set(url, info, err, ttl)
     return info, err
 
 
@@ -184,27 +498,39 @@ async def _extract_info_async(url: str) -> Tuple[Optional[dict], Optional[str]]:
     cached = _metadata_cache_get(url)
     if cached is not None:
         return cached
-    info, err = await _run_blocking_with_limit(_probe_semaphore, _extract_info_uncached, url)
-    _metadata_cache_set(url, info, err)
-    return info, err
+    # Одновременные запросы одной ссылки ждут общий вызов extract_info
+    task = _metadata_inflight.get(url)
+    if task is None:
+        task = asyncio.ensure_future(_probe_and_cache(url))
+        _metadata_inflight[url] = task
+        task.add_done_callback(lambda _: _metadata_inflight.pop(url, None))
+    return await asyncio.shield(task)
 
 
-def _best_direct_url(info: dict, max_bytes: int) -> Optional[str]:
-    # Постараемся выбрать прямой URL подходящего формата в пределах max_bytes
+def _probe_formats(info: dict, tg_limit_bytes: int, max_bytes: int) -> Tuple[bool, Optional[str]]:
+    """Один проход по форматам: (есть ли формат с известным размером <= tg_limit, лучший прямой URL)."""
+    size_top = info.get("filesize") or info.get("filesize_approx")
+    has_under = bool(size_top and size_top <= tg_limit_bytes)
     fmts = info.get("formats") or []
     best = None
     best_score = -1e9
     for f in fmts:
-        url = f.get("url")
+        get = f.get
+        size = get("filesize") or get("filesize_approx")
+        if size and size <= tg_limit_bytes:
+            has_under = True
+        # Постараемся выбрать прямой URL подходящего формата в пределах max_bytes
+        url = get("url")
         if not url:
             continue
-        size = f.get("filesize") or f.get("filesize_approx")
         if size and size > max_bytes:
             continue
-        proto = (f.get("protocol") or "").lower()
-        ext = (f.get("ext") or "").lower()
-        height = f.get("height") or 0
-        tbr = f.get("tbr") or 0
+        proto = get("protocol")
+        proto = proto.lower() if proto else ""
+        ext = get("ext")
+        ext = ext.lower() if ext else ""
+        height = get("height") or 0
+        tbr = get("tbr") or 0
         score = 0.0
         if ext == "mp4":
             score += 50
@@ -217,19 +543,73 @@ def _best_direct_url(info: dict, max_bytes: int) -> Optional[str]:
         if score > best_score:
             best_score = score
             best = f
-    return (best or {}).get("url") or info.get("url") or info.get("webpage_url")
+    return has_under, (best or {}).get("url") or info.get("url") or info.get("webpage_url")
 
 
-def _has_known_under_limit(info: dict, limit_bytes: int) -> bool:
-    size_top = info.get("filesize") or info.get("filesize_approx")
-    if size_top and size_top <= limit_bytes:
-        return True
-    fmts = info.get("formats") or []
-    for f in fmts:
-        size = f.get("filesize") or f.get("filesize_approx")
-        if size and size <= limit_bytes:
-            return True
-    return False
+def _best_direct_url(info: dict, max_bytes: int) -> Optional[str]:
+    return _probe_formats(info, 0, max_bytes)[1]
+
+
+def _direct_link_result(url: str, probe_info: dict, direct_url: Optional[str]) -> DownloadResult:
+    return DownloadResult(
+        ok=True,
+        filepath=None,
+        title=probe_info.get("title"),
+        ext=probe_info.get("ext"),
+        filesize=None,
+        duration=probe_info.get("duration"),
+        thumbnail=probe_info.get("thumbnail"),
+        webpage_url=probe_info.get("webpage_url") or url,
+        direct_url=direct_url,
+        kind=_pick_kind(probe_info),
+    )
+
+
+# Поля, которые проба дописывает на верхний уровень info при выборе формата
+_SELECTION_KEYS = frozenset((
+    "requested_formats",
+    "requested_downloads",
+    "requested_subtitles",
+    "format_id",
+    "format",
+    "url",
+    "manifest_url",
+    "protocol",
+    "ext",
+))
+# Поля ролика, которые встречаются и в форматах, но выбором формата не определяются
+_VIDEO_KEYS = frozenset((
+    "id",
+    "title",
+    "duration",
+    "thumbnail",
+    "thumbnails",
+    "webpage_url",
+    "original_url",
+    "extractor",
+    "extractor_key",
+    "formats",
+))
+
+
+def _reprocessable_info(probe_info: dict) -> dict:
+    """Копия info пробы без результата её выбора формата — для process_ie_result.
+
+    Проба уже выбрала формат по умолчанию (requested_formats и поля лучшего формата
+    на верхнем уровне). Если их оставить, yt-dlp скачает и смёрджит выбор пробы
+    вместо выбора пользователя.
+    """
+    info = copy.deepcopy(probe_info)
+    formats = info.get("formats")
+    if not formats:
+        # Единственный формат — сам info: выбирать нечего, поля формата нужны как есть
+        return info
+    stale = set(_SELECTION_KEYS)
+    for f in formats:
+        stale.update(f)
+    for key in stale - _VIDEO_KEYS:
+        info.pop(key, None)
+    return info
 
 
 def _download(
@@ -237,35 +617,23 @@ def _download(
     tg_limit_bytes: int,
     dl_max_bytes: int,
     on_progress: Optional[Callable[[str, int, Optional[int], Optional[float], Optional[float]], None]] = None,
+    probe_info: Optional[dict] = None,
 ) -> DownloadResult:
-    temp_dir = tempfile.mkdtemp(prefix="dlyt_")
+    temp_dir = _make_temp_dir(probe_info)
     tg_limit = _format_limit_str(tg_limit_bytes)
 
     try:
         # Сначала извлечём метаданные, чтобы понять — пробуем ли качать под лимит TG
-        probe_info, _ = _extract_info_sync(url)
+        if probe_info is None:
+            probe_info, _ = _extract_info_sync(url)
         if not isinstance(probe_info, dict):
             raise RuntimeError("Failed to extract info")
 
         # Если нет формата с известным размером <= лимита TG — отдаём прямой URL, не качаем
-        if not _has_known_under_limit(probe_info, tg_limit_bytes):
-            direct_url = _best_direct_url(probe_info, dl_max_bytes)
-            try:
-                shutil.rmtree(temp_dir, ignore_errors=True)
-            except Exception:
-                pass
-            return DownloadResult(
-                ok=True,
-                filepath=None,
-                title=probe_info.get("title"),
-                ext=probe_info.get("ext"),
-                filesize=None,
-                duration=probe_info.get("duration"),
-                thumbnail=probe_info.get("thumbnail"),
-                webpage_url=probe_info.get("webpage_url") or url,
-                direct_url=direct_url,
-                kind=_pick_kind(probe_info),
-            )
+        has_under_limit, direct_url = _probe_formats(probe_info, tg_limit_bytes, dl_max_bytes)
+        if not has_under_limit:
+            _cleanup_flat(temp_dir)
+            return _direct_link_result(url, probe_info, direct_url)
 
         # Пытаемся подобрать формат в пределах лимита и с mp4, чтобы Телеграм принял
         format_selector = (
@@ -274,33 +642,6 @@ def _download(
             f"/best[filesize<=?{tg_limit}]"
         )
 
-        def _hook(d: Dict):
-            if not on_progress:
-                return
-            status = d.get("status") or ""
-            if status == "downloading":
-                downloaded = int(d.get("downloaded_bytes") or 0)
-                total = d.get("total_bytes") or d.get("total_bytes_estimate")
-                speed = d.get("speed")
-                eta = d.get("eta")
-                on_progress(
-                    "downloading",
-                    downloaded,
-                    int(total) if total else None,
-                    float(speed) if speed else None,
-                    float(eta) if eta else None,
-                )
-            elif status == "finished":
-                on_progress("finished", int(d.get("downloaded_bytes") or 0), int(d.get("total_bytes") or 0), None, None)
-
-        cookies_file = get_ytdlp_cookies_file()
-        cookies_browser = get_ytdlp_cookies_from_browser()
-        cookies_opts: Dict = {}
-        if cookies_file:
-            cookies_opts["cookiefile"] = cookies_file
-        elif cookies_browser:
-            cookies_opts["cookiesfrombrowser"] = (cookies_browser,)
-
         ydl_opts = {
             "format": format_selector,
             "outtmpl": os.path.join(temp_dir, "%(title).180B [%(id)s].%(ext)s"),
@@ -311,49 +652,31 @@ def _download(
             "merge_output_format": "mp4",
             "postprocessors": [
                 {
-                    "key": "FFmpegVideoConvertor",
-                    "preferedformat": "mp4",
+                    "key": "FFmpegVideoRemuxer",
+                    "preferedformat": _MP4_CONVERT_MAPPING,
                 }
             ],
-            "progress_hooks": [_hook],
             "concurrent_fragment_downloads": _FRAGMENT_CONCURRENCY,
             "retries": 10,
             "fragment_retries": 20,
-            **cookies_opts,
+            **_FRAGMENT_DOWNLOADER_OPTS,
+            **_cookies_opts(),
         }
+        if on_progress is not None:
+            ydl_opts["progress_hooks"] = [_ProgressHook(on_progress)]
 
         with ytdlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
+            # Метаданные уже извлечены — не резолвим ссылку повторно
+            info = ydl.process_ie_result(_reprocessable_info(probe_info), download=True)
             # Выясняем итоговый путь файла
-            filepath = None
-            if isinstance(info, dict):
-                req = info.get("requested_downloads") or []
-                for r in req:
-                    fp = r.get("filepath")
-                    if fp and os.path.exists(fp):
-                        filepath = fp
-                        break
-                if not filepath:
-                    filepath = info.get("_filename")
-            if not filepath or not os.path.exists(filepath):
-                files = [
-                    os.path.join(temp_dir, f)
-                    for f in os.listdir(temp_dir)
-                    if os.path.isfile(os.path.join(temp_dir, f))
-                ]
-                if files:
-                    filepath = files[0]
-
-            size = os.path.getsize(filepath) if filepath and os.path.exists(filepath) else None
+            filepath = _resolve_download_path(ydl, info)
+            size = os.path.getsize(filepath)
             kind = _pick_kind(info) if isinstance(info, dict) else "document"
 
-            if size is not None and size > tg_limit_bytes:
+            if size > tg_limit_bytes:
                 # Не отправляем файл, отдаём прямую ссылку
                 direct_url = _best_direct_url(info if isinstance(info, dict) else probe_info, dl_max_bytes)
-                try:
-                    shutil.rmtree(temp_dir, ignore_errors=True)
-                except Exception:
-                    pass
+                _cleanup_flat(temp_dir)
                 return DownloadResult(
                     ok=True,
                     filepath=None,
@@ -386,10 +709,7 @@ def _download(
         if isinstance(info, dict):
             direct_url = _best_direct_url(info, dl_max_bytes)
         # Чистим временную папку на всякий случай
-        try:
-            shutil.rmtree(temp_dir, ignore_errors=True)
-        except Exception:
-            pass
+        _cleanup_flat(temp_dir)
         return DownloadResult(
             ok=False,
             filepath=None,
@@ -412,138 +732,142 @@ async def download_media(
 ) -> DownloadResult:
     tg_limit_bytes = max(1, telegram_limit_mb) * 1024 * 1024
     dl_max_bytes = max(1, download_max_mb) * 1024 * 1024
+    # Проба идёт через кеш/общий вызов и не занимает слот загрузки
+    probe_info, _ = await _extract_info_async(url)
+    if isinstance(probe_info, dict):
+        # Файл заведомо больше лимита TG — отдаём ссылку, слот загрузки не нужен
+        has_under_limit, direct_url = _probe_formats(probe_info, tg_limit_bytes, dl_max_bytes)
+        if not has_under_limit:
+            return _direct_link_result(url, probe_info, direct_url)
+    else:
+        probe_info = None
     return await _run_blocking_with_limit(
+        _DOWNLOAD_POOL,
         _download_semaphore,
         _download,
         url,
         tg_limit_bytes,
         dl_max_bytes,
         None,
+        probe_info,
     )
 
 
 # -------- Форматы и выбор качества ---------
 
+_SIZE_UNITS = ("Б", "КБ", "МБ", "ГБ")
+
+
 def _human_size(nbytes: Optional[int]) -> str:
     if not nbytes:
         return "?"
-    units = ["Б", "КБ", "МБ", "ГБ"]
-    size = float(nbytes)
-    for u in units:
-        if size < 1024 or u == units[-1]:
-            return f"{size:.1f} {u}".replace(".0", "")
-        size /= 1024
-    return f"{nbytes} Б"
+    # Порядок единицы — по числу бит: каждые 10 бит это следующая степень 1024
+    unit_idx = min((int(nbytes).bit_length() - 1) // 10, len(_SIZE_UNITS) - 1) if nbytes > 0 else 0
+    size = nbytes / (1 << (unit_idx * 10))
+    return f"{size:.1f} {_SIZE_UNITS[unit_idx]}".replace(".0", "")
 
 
-def _pick_audio_fmt(formats: List[Dict]) -> Optional[Dict]:
-    cand = []
-    for f in formats:
-        ac = (f.get("acodec") or "none").lower()
-        vc = (f.get("vcodec") or "none").lower()
-        if ac != "none" and vc == "none":
-            cand.append(f)
-    # Предпочитаем m4a/mp3/ogg/opus по bitrate
-    def score(f: Dict) -> float:
-        ext = (f.get("ext") or "").lower()
-        tbr = f.get("abr") or f.get("tbr") or 0
-        s = float(tbr)
-        if ext == "m4a":
-            s += 20
-        elif ext in ("mp3", "ogg", "opus"):
-            s += 10
-        size = f.get("filesize") or f.get("filesize_approx")
-        if size:
-            s += min(size / (1024 * 1024), 10)  # небольшой бонус
-        return s
-
-    cand.sort(key=score, reverse=True)
-    return cand[0] if cand else None
-
-
-def _pick_video_fmt(formats: List[Dict], max_height: Optional[int]) -> Optional[Dict]:
-    cand = []
+def _classify_formats(formats: List[Dict]) -> Tuple[List[tuple], List[tuple], List[tuple]]:
+    """Один проход по форматам: (audio, video_only, progressive) из кортежей (score, height, size, fmt)."""
+    audio: List[tuple] = []
+    video: List[tuple] = []
+    progressive: List[tuple] = []
     for f in formats:
-        ac = (f.get("acodec") or "none").lower()
-        vc = (f.get("vcodec") or "none").lower()
-        if vc != "none" and ac == "none":
-            h = f.get("height") or 0
-            if (max_height is None) or (h and h <= max_height):
-                cand.append(f)
-
-    def score(f: Dict) -> float:
-        ext = (f.get("ext") or "").lower()
-        h = f.get("height") or 0
-        tbr = f.get("tbr") or 0
-        s = float(h) / 10 + float(tbr)
+        get = f.get
+        ac = get("acodec")
+        ac = ac.lower() if ac else "none"
+        vc = get("vcodec")
+        vc = vc.lower() if vc else "none"
+        ext = get("ext")
+        ext = ext.lower() if ext else ""
+        size = get("filesize") or get("filesize_approx")
+        if vc == "none":
+            if ac == "none":
+                continue
+            # Предпочитаем m4a/mp3/ogg/opus по bitrate
+            s = float(get("abr") or get("tbr") or 0)
+            if ext == "m4a":
+                s += 20
+            elif ext in ("mp3", "ogg", "opus"):
+                s += 10
+            if size:
+                s += min(size / (1024 * 1024), 10)  # небольшой бонус
+            audio.append((s, 0, size, f))
+            continue
+        h = get("height") or 0
+        s = float(h) / 10 + float(get("tbr") or 0)
         if ext == "mp4":
             s += 50
-        return s
-
-    cand.sort(key=score, reverse=True)
-    return cand[0] if cand else None
+        (video if ac == "none" else progressive).append((s, h, size, f))
+    return audio, video, progressive
 
 
-def _pick_progressive_fmt(formats: List[Dict], max_height: Optional[int]) -> Optional[Dict]:
-    cand = []
-    for f in formats:
-        ac = (f.get("acodec") or "none").lower()
-        vc = (f.get("vcodec") or "none").lower()
-        if vc != "none" and ac != "none":
-            h = f.get("height") or 0
-            if (max_height is None) or (h and h <= max_height):
-                cand.append(f)
-
-    def score(f: Dict) -> float:
-        ext = (f.get("ext") or "").lower()
-        h = f.get("height") or 0
-        tbr = f.get("tbr") or 0
-        s = float(h) / 10 + float(tbr)
-        if ext == "mp4":
-            s += 50
-        return s
-
-    cand.sort(key=score, reverse=True)
-    return cand[0] if cand else None
+def _best_scored(cands: List[tuple], max_height: Optional[int] = None) -> Optional[tuple]:
+    best = None
+    best_score = 0.0
+    for entry in cands:
+        h = entry[1]
+        if max_height is not None and not (h and h <= max_height):
+            continue
+        if best is None or entry[0] > best_score:
+            best_score = entry[0]
+            best = entry
+    return best
+
+
+def _best_by_height(cands: List[tuple], heights: List[int]) -> Dict[int, Optional[tuple]]:
+    """То же, что _best_scored(cands, h) для каждого h, но за один проход по кандидатам."""
+    best: Dict[int, Optional[tuple]] = dict.fromkeys(heights)
+    for entry in cands:
+        h = entry[1]
+        if not h:
+            continue
+        score = entry[0]
+        for limit in heights:
+            if h <= limit:
+                cur = best[limit]
+                if cur is None or score > cur[0]:
+                    best[limit] = entry
+    return best
 
 
-def _fmt_selector(kind: str, quality: str, limit_mb: Optional[int] = None) -> str:
+def _build_fmt_selector(kind: str, quality: str) -> str:
     # kind: 'va' | 'v' | 'a'; quality: 'best'|'1080'|'720'|'480'|'360'
-    limit = _format_limit_str(limit_mb * 1024 * 1024) if limit_mb else None
-
+    # Суммарный размер yt-dlp ограничить не даёт, поэтому лимит в селектор не входит
     hsel = ""
     if quality.isdigit():
         hsel = f"[height<=?{quality}]"
 
     if kind == "a":
-        base = "bestaudio[ext=m4a]/bestaudio/best"
-        return base
+        return "bestaudio[ext=m4a]/bestaudio/best"
     if kind == "v":
-        parts = [
-            f"bestvideo[ext=mp4]{hsel}",
-            f"/bestvideo{hsel}",
-        ]
-        s = "".join(parts)
-        return s
+        return f"bestvideo[ext=mp4]{hsel}/bestvideo{hsel}"
     # kind == 'va'
-    parts = [
-        f"bestvideo[ext=mp4]{hsel}+bestaudio[ext=m4a]",
-        f"/best{hsel}[ext=mp4]",
-        f"/best{hsel}",
-    ]
-    s = "".join(parts)
-    if limit:
-        # yt-dlp не позволяет легко ограничить суммарный размер, поэтому оставляем без ограничения здесь
-        return s
-    return s
+    return f"bestvideo[ext=mp4]{hsel}+bestaudio[ext=m4a]/best{hsel}[ext=mp4]/best{hsel}"
+
+
+_SELECTOR_TABLE: Dict[Tuple[str, str], str] = {
+    (kind, quality): _build_fmt_selector(kind, quality)
+    for kind in ("a", "v", "va")
+    for quality in ("best", "1080", "720", "480", "360")
+}
+
+
+def _fmt_selector(kind: str, quality: str) -> str:
+    selector = _SELECTOR_TABLE.get((kind, quality))
+    if selector is None:
+        selector = _build_fmt_selector(kind, quality)
+    return selector
 
 
 def _estimate_sizes(info: dict) -> List[FormatOption]:
     formats = info.get("formats") or []
     opts: List[FormatOption] = []
     heights = [1080, 720, 480, 360]
-    aud = _pick_audio_fmt(formats)
-    aud_size = (aud.get("filesize") or aud.get("filesize_approx")) if aud else None
+    audio, video, progressive = _classify_formats(formats)
+    aud_entry = _best_scored(audio)
+    aud = aud_entry[3] if aud_entry else None
+    aud_size = aud_entry[2] if aud_entry else None
 
     # Audio only (only if present)
     if aud:
@@ -558,11 +882,14 @@ def _estimate_sizes(info: dict) -> List[FormatOption]:
             )
         )
 
+    video_by_height = _best_by_height(video, heights)
+    progressive_by_height = _best_by_height(progressive, heights)
+
     # Video only for heights
     for h in heights:
-        v = _pick_video_fmt(formats, h)
-        if v:
-            v_size = (v.get("filesize") or v.get("filesize_approx"))
+        v_entry = video_by_height[h]
+        if v_entry:
+            v_size, v = v_entry[2], v_entry[3]
             opts.append(
                 FormatOption(
                     kind="v",
@@ -577,17 +904,16 @@ def _estimate_sizes(info: dict) -> List[FormatOption]:
 
     # Video+audio
     for h in heights:
-        v = _pick_video_fmt(formats, h)
-        if v and aud:
-            v_size = (v.get("filesize") or v.get("filesize_approx"))
-            est = (v_size or 0) + (aud_size or 0)
-            candidate = v
+        v_entry = video_by_height[h]
+        if v_entry and aud:
+            est = (v_entry[2] or 0) + (aud_size or 0)
+            candidate = v_entry[3]
         else:
             # Фолбек — прогрессивный формат
-            p = _pick_progressive_fmt(formats, h)
-            if p:
-                est = (p.get("filesize") or p.get("filesize_approx"))
-                candidate = p
+            p_entry = progressive_by_height[h]
+            if p_entry:
+                est = p_entry[2]
+                candidate = p_entry[3]
             else:
                 est = None
                 candidate = None
@@ -605,9 +931,9 @@ def _estimate_sizes(info: dict) -> List[FormatOption]:
             )
 
     # Best VA
-    pbest = _pick_progressive_fmt(formats, None)
-    if pbest:
-        est_best = (pbest.get("filesize") or pbest.get("filesize_approx"))
+    pbest_entry = _best_scored(progressive)
+    if pbest_entry:
+        est_best, pbest = pbest_entry[2], pbest_entry[3]
         opts.insert(
             0,
             FormatOption(
@@ -687,34 +1013,9 @@ def _download_with_selector(
     url: str,
     selector: str,
     on_progress: Optional[Callable[[str, int, Optional[int], Optional[float], Optional[float]], None]] = None,
+    probe_info: Optional[dict] = None,
 ) -> DownloadResult:
-    temp_dir = tempfile.mkdtemp(prefix="dlyt_")
-    def _hook(d: Dict):
-        if not on_progress:
-            return
-        status = d.get("status") or ""
-        if status == "downloading":
-            downloaded = int(d.get("downloaded_bytes") or 0)
-            total = d.get("total_bytes") or d.get("total_bytes_estimate")
-            speed = d.get("speed")
-            eta = d.get("eta")
-            on_progress(
-                "downloading",
-                downloaded,
-                int(total) if total else None,
-                float(speed) if speed else None,
-                float(eta) if eta else None,
-            )
-        elif status == "finished":
-            on_progress("finished", int(d.get("downloaded_bytes") or 0), int(d.get("total_bytes") or 0), None, None)
-
-    cookies_file = get_ytdlp_cookies_file()
-    cookies_browser = get_ytdlp_cookies_from_browser()
-    cookies_opts: Dict = {}
-    if cookies_file:
-        cookies_opts["cookiefile"] = cookies_file
-    elif cookies_browser:
-        cookies_opts["cookiesfrombrowser"] = (cookies_browser,)
+    temp_dir = _make_temp_dir(probe_info)
 
     ydl_opts = {
         "format": selector,
@@ -726,38 +1027,28 @@ def _download_with_selector(
         "merge_output_format": "mp4",
         "postprocessors": [
             {
-                "key": "FFmpegVideoConvertor",
-                "preferedformat": "mp4",
+                "key": "FFmpegVideoRemuxer",
+                "preferedformat": _MP4_CONVERT_MAPPING,
             }
         ],
-        "progress_hooks": [_hook],
         "concurrent_fragment_downloads": _FRAGMENT_CONCURRENCY,
         "retries": 10,
         "fragment_retries": 20,
-        **cookies_opts,
+        **_FRAGMENT_DOWNLOADER_OPTS,
+        **_cookies_opts(),
     }
+    # Без потребителя хук не регистрируем: yt-dlp не будет вызывать Python на каждый фрагмент
+    if on_progress is not None:
+        ydl_opts["progress_hooks"] = [_ProgressHook(on_progress)]
     try:
         with ytdlp.YoutubeDL(ydl_opts) as ydl:
-            info = ydl.extract_info(url, download=True)
-            filepath = None
-            if isinstance(info, dict):
-                req = info.get("requested_downloads") or []
-                for r in req:
-                    fp = r.get("filepath")
-                    if fp and os.path.exists(fp):
-                        filepath = fp
-                        break
-                if not filepath:
-                    filepath = info.get("_filename")
-            if not filepath or not os.path.exists(filepath):
-                files = [
-                    os.path.join(temp_dir, f)
-                    for f in os.listdir(temp_dir)
-                    if os.path.isfile(os.path.join(temp_dir, f))
-                ]
-                if files:
-                    filepath = files[0]
-            size = os.path.getsize(filepath) if filepath and os.path.exists(filepath) else None
+            if probe_info is not None:
+                # Метаданные уже получены при показе меню — повторно экстрактор не вызываем
+                info = ydl.process_ie_result(_reprocessable_info(probe_info), download=True)
+            else:
+                info = ydl.extract_info(url, download=True)
+            filepath = _resolve_download_path(ydl, info)
+            size = os.path.getsize(filepath)
             kind = _pick_kind(info) if isinstance(info, dict) else "document"
             return DownloadResult(
                 ok=True,
@@ -772,7 +1063,9 @@ def _download_with_selector(
                 kind=kind,
             )
     except Exception as e:  # noqa: BLE001
-        info, _ = _extract_info_sync(url)
+        # Частичные фрагменты не оставляем — temp_dir может лежать в RAM (TMPFS_DIR)
+        _cleanup_flat(temp_dir)
+        info = probe_info if probe_info is not None else _extract_info_sync(url)[0]
         return DownloadResult(
             ok=False,
             filepath=None,
@@ -800,41 +1093,44 @@ async def download_media_selected(
     progress: Optional[Callable[[str, int, Optional[int], Optional[float], Optional[float]], None]] = None,
 ) -> DownloadResult:
     selector = _fmt_selector(kind, quality)
-    loop = asyncio.get_running_loop()
-
-    def _safe_progress(status: str, downloaded: int, total: Optional[int], speed: Optional[float], eta: Optional[float]) -> None:
-        if progress is None:
-            return
-        try:
-            import asyncio as _asyncio  # local alias
-            loop.call_soon_threadsafe(_asyncio.create_task, progress(status, downloaded, total, speed, eta))
-        except Exception:
-            pass
+    probe_info, _ = await _extract_info_async(url)
+    if not isinstance(probe_info, dict):
+        probe_info = None
+    relay = _ProgressRelay(asyncio.get_running_loop(), progress) if progress is not None else None
+    on_progress = relay.push if relay is not None else None
 
-    # First attempt with chosen selector
-    res = await _run_blocking_with_limit(
-        _download_semaphore,
-        _download_with_selector,
-        url,
-        selector,
-        _safe_progress,
-    )
-    if res.ok:
+    try:
+        # First attempt with chosen selector
+        res = await _run_blocking_with_limit(
+            _DOWNLOAD_POOL,
+            _download_semaphore,
+            _download_with_selector,
+            url,
+            selector,
+            on_progress,
+            probe_info,
+        )
+        if res.ok:
+            return res
+        # Fallbacks for sources with limited formats (e.g., Pinterest)
+        err = (res.error or "").lower()
+        if ("requested format" in err) or ("no video formats" in err) or ("no such format" in err):
+            for sel in (
+                "bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best",
+                "best",
+            ):
+                res2 = await _run_blocking_with_limit(
+                    _DOWNLOAD_POOL,
+                    _download_semaphore,
+                    _download_with_selector,
+                    url,
+                    sel,
+                    on_progress,
+                    probe_info,
+                )
+                if res2.ok:
+                    return res2
         return res
-    # Fallbacks for sources with limited formats (e.g., Pinterest)
-    err = (res.error or "").lower()
-    if ("requested format" in err) or ("no video formats" in err) or ("no such format" in err):
-        for sel in (
-            "bestvideo[ext=mp4]+bestaudio[ext=m4a]/best[ext=mp4]/best",
-            "best",
-        ):
-            res2 = await _run_blocking_with_limit(
-                _download_semaphore,
-                _download_with_selector,
-                url,
-                sel,
-                _safe_progress,
-            )
-            if res2.ok:
-                return res2
-    return res
+    finally:
+        if relay is not None:
+            await relay.aclose()
@@ -1,12 +1,14 @@
 import asyncio
-import os
 import logging
 import shutil
 from pathlib import Path
 import re
 import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import suppress
 from dataclasses import dataclass
+from functools import lru_cache, partial
 from html import escape as html_escape
 from typing import Awaitable, Callable
 
@@ -43,6 +45,7 @@ try:
     from .state import (  # type: ignore
         put_payload,
         get_payload,
+        drop_payload,
         get_user_lang,
         set_user_lang,
         get_user_last_request,
@@ -71,6 +74,7 @@ except Exception:  # pragma: no cover
     from state import (
         put_payload,
         get_payload,
+        drop_payload,
         get_user_lang,
         set_user_lang,
         get_user_last_request,
@@ -85,9 +89,67 @@ router = Router()
 
 URL_RE = re.compile(r"(https?://\S+)")
 UB_MARK_RE = re.compile(r"\bUB\|([A-Za-z0-9_\-]+)\b")
+# callback_data разбираем одним match: неверное действие отсекается до чтения payload
+MENU_CB_RE = re.compile(r"menu\|([^|]*)\|(more|back)")
+FMT_CB_RE = re.compile(r"fmt\|([^|]*)\|([^|]*)\|([^|]*)")
 
 
 _ACTIVE_DOWNLOADS: set[asyncio.Task] = set()
+# Ограничение одновременных правок сообщений, чтобы не упереться в flood-защиту
+_EDIT_SEM = asyncio.Semaphore(8)
+# Удаление временных каталогов: пара потоков, чтобы очистка не отнимала общий executor и не дёргала диск десятками потоков
+_DISK_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix="ytbot-disk")
+
+
+class _EditLimiter:
+    """Окна частоты правок: не чаще раза в ``chat_interval`` секунд в чате и ``global_rate`` правок в секунду на бота.
+
+    Так Telegram не отвечает 429 (flood-wait), который тормозит все правки бота разом.
+    """
+
+    def __init__(self, chat_interval: float, global_rate: int) -> None:
+        self.chat_interval = chat_interval
+        self.global_rate = global_rate
+        self._chat_last: dict[int, float] = {}
+        self._recent: deque[float] = deque()
+
+    def chat_ready(self, chat_id: int, now: float) -> bool:
+        last = self._chat_last.get(chat_id)
+        return last is None or (now - last) >= self.chat_interval
+
+    def _delay(self, chat_id: int, now: float) -> float:
+        last = self._chat_last.get(chat_id)
+        wait = 0.0 if last is None else last + self.chat_interval - now
+        recent = self._recent
+        while recent and (now - recent[0]) >= 1.0:
+            recent.popleft()
+        if len(recent) >= self.global_rate:
+            wait = max(wait, recent[0] + 1.0 - now)
+        return wait
+
+    async def acquire(self, chat_id: int) -> None:
+        # Ждём, пока освободятся оба окна; проверка и запись без await между ними
+        while True:
+            now = time.monotonic()
+            wait = self._delay(chat_id, now)
+            if wait <= 0:
+                self._chat_last[chat_id] = now
+                self._recent.append(now)
+                return
+            await asyncio.sleep(wait)
+
+    def forget(self, chat_id: int) -> None:
+        self._chat_last.pop(chat_id, None)
+
+
+_EDIT_LIMITER = _EditLimiter(chat_interval=1.0, global_rate=30)
+
+
+async def _edit_message(message: Message, text: str, **kwargs) -> None:
+    # Правки статусов идут через окна частоты и семафор; ошибки Telegram пробрасываются вызывающему
+    await _EDIT_LIMITER.acquire(message.chat.id)
+    async with _EDIT_SEM:
+        await message.edit_text(text, **kwargs)
 
 
 @dataclass
@@ -95,7 +157,19 @@ class DownloadListener:
     origin_message: Message
     wait_msg: Message
     lang: str
-    edit_progress: Callable[[str, str, float | None], Awaitable[None]]
+    last_text: str | None = None
+
+    async def send(self, text: str) -> None:
+        # Telegram отвечает ошибкой на правку тем же текстом — такие правки не отправляем
+        if text == self.last_text:
+            return
+        try:
+            await _edit_message(self.wait_msg, text)
+        except Exception as exc:  # noqa: BLE001
+            # Неудачную правку (flood-wait, сеть) не запоминаем — следующий вызов повторит её
+            if "message is not modified" not in str(exc):
+                return
+        self.last_text = text
 
 
 @dataclass
@@ -106,6 +180,26 @@ class DownloadJob:
     quality: str
     listeners: list[DownloadListener]
     task: asyncio.Task | None = None
+    throttle_pct: float = -5.0
+    throttle_ts: float = 0.0
+
+    def should_update(self, status: str, pct: float | None) -> bool:
+        # Один ограничитель частоты на задачу, а не на каждого слушателя
+        if status not in {"downloading", "uploading"}:
+            return True
+        now = time.monotonic()
+        # Пока окно чата занято, промежуточные тики отбрасываем; финальный (100%) дождётся окна в send()
+        if (pct is None or pct < 100.0) and not _EDIT_LIMITER.chat_ready(self.key[0], now):
+            return False
+        if pct is None:
+            ok = (now - self.throttle_ts) >= 1.0
+        else:
+            ok = pct >= 99.0 or (pct - self.throttle_pct) >= 2.0 or (now - self.throttle_ts) >= 1.0
+        if ok:
+            self.throttle_ts = now
+            if pct is not None:
+                self.throttle_pct = pct
+        return ok
 
 
 _ACTIVE_JOBS: dict[tuple[int, str, str, str], DownloadJob] = {}
@@ -121,8 +215,15 @@ class DeliveryCacheEntry:
     expires_at: float
 
 
-_DELIVERY_CACHE: dict[tuple[int, str, str, str], DeliveryCacheEntry] = {}
+# Ключ — (url, kind, quality) без chat_id: file_id бота действителен в любом чате
+_DELIVERY_CACHE: "OrderedDict[tuple[str, str, str], DeliveryCacheEntry]" = OrderedDict()
 _CACHE_TTL_SECONDS = 15 * 60
+_MAX_CACHE_ENTRIES = 2048
+# Раз в столько записей проходим кеш целиком и выкидываем просроченное
+_CACHE_SWEEP_EVERY = 256
+_cache_stores = 0
+
+_UPLOAD_CHUNK_SIZE = 1024 * 1024
 
 
 _MAX_ACTIVE_JOBS = max(0, get_max_active_jobs())
@@ -130,95 +231,43 @@ _MAX_CHAT_JOBS = max(0, get_max_chat_jobs())
 _USER_COOLDOWN = max(0, get_user_cooldown_seconds())
 
 
-def _options_to_payload(options: list[FormatOption]) -> list[dict[str, object]]:
-    payload: list[dict[str, object]] = []
-    for opt in options:
-        payload.append(
-            {
-                "kind": opt.kind,
-                "quality": opt.quality,
-                "est_size": int(opt.est_size) if isinstance(opt.est_size, (int, float)) else None,
-                "label": opt.label,
-                "height": int(opt.height) if isinstance(opt.height, (int, float)) else None,
-                "bitrate_k": float(opt.bitrate_k) if isinstance(opt.bitrate_k, (int, float)) else None,
-                "ext": opt.ext,
-            }
-        )
-    return payload
+@lru_cache(maxsize=512)
+def _tc(lang: str, key: str) -> str:
+    # Перевод без параметров: строки меню повторяются на каждой отрисовке
+    return t(lang, key)
+
+
+def _options_to_payload(options: list[FormatOption]) -> tuple[FormatOption, ...]:
+    # Хранилище токенов живёт в памяти процесса: кладём сами объекты без сериализации в dict
+    return tuple(options)
 
 
 def _options_from_payload(raw: object) -> list[FormatOption]:
-    if not isinstance(raw, list):
+    if not isinstance(raw, tuple):
         return []
-    options: list[FormatOption] = []
-    for item in raw:
-        if not isinstance(item, dict):
-            continue
-        est_size = item.get("est_size")
-        if isinstance(est_size, float):
-            est_size = int(est_size)
-        elif not isinstance(est_size, int):
-            est_size = None
-        height = item.get("height")
-        if isinstance(height, float):
-            height = int(height)
-        elif not isinstance(height, int):
-            height = None
-        bitrate = item.get("bitrate_k")
-        if isinstance(bitrate, str):
-            try:
-                bitrate = float(bitrate)
-            except ValueError:
-                bitrate = None
-        elif not isinstance(bitrate, (int, float)):
-            bitrate = None
-        options.append(
-            FormatOption(
-                kind=str(item.get("kind") or "va"),
-                quality=str(item.get("quality") or "best"),
-                est_size=est_size,
-                label=str(item.get("label") or ""),
-                height=height,
-                bitrate_k=float(bitrate) if bitrate is not None else None,
-                ext=(str(item.get("ext")) if item.get("ext") else None),
-            )
-        )
-    return options
+    return list(raw)
+
+
+_EXT_PRIORITY = {"mp4": 4, "mkv": 3, "mov": 3, "webm": 2, "m4a": 2}
 
 
 def _ext_priority(ext: str | None) -> int:
     if not ext:
         return 0
-    ext = ext.lower()
-    if ext == "mp4":
-        return 4
-    if ext in {"mkv", "mov"}:
-        return 3
-    if ext in {"webm", "m4a"}:
-        return 2
-    return 1
+    return _EXT_PRIORITY.get(ext.lower(), 1)
 
 
 def _dedupe_options(options: list[FormatOption]) -> list[FormatOption]:
-    unique: dict[tuple[str, str], FormatOption] = {}
+    unique: dict[tuple[str, str], tuple[tuple[bool, float, int], FormatOption]] = {}
     for opt in options:
         key = (opt.kind, str(opt.quality))
-        best = unique.get(key)
-        if not best:
-            unique[key] = opt
-            continue
         # Prefer option with known size, smaller size, or better extension.
-        best_size = best.est_size or 0
-        opt_size = opt.est_size or 0
-        if best.est_size is None and opt.est_size is not None:
-            unique[key] = opt
-            continue
-        if opt.est_size is not None and best.est_size is not None and opt_size < best_size:
-            unique[key] = opt
-            continue
-        if opt.est_size == best.est_size and _ext_priority(opt.ext) > _ext_priority(best.ext):
-            unique[key] = opt
-    return list(unique.values())
+        size = opt.est_size
+        score = (size is None, size or 0, -_ext_priority(opt.ext))
+        cur = unique.get(key)
+        if cur is None or score < cur[0]:
+            unique[key] = (score, opt)
+    return [opt for _, opt in unique.values()]
 
 
 def _quality_value(opt: FormatOption) -> int:
@@ -248,6 +297,12 @@ def _matches_quality(opt: FormatOption, target: int) -> bool:
     return False
 
 
+def _prepare_options(options: list[FormatOption]) -> list[FormatOption]:
+    # Один раз при сохранении в payload: без дублей и по убыванию качества.
+    # Сортировка стабильна, поэтому любая выборка по kind остаётся отсортированной
+    return sorted(_dedupe_options(options), key=_quality_value, reverse=True)
+
+
 def _select_preferred_va_option(options: list[FormatOption]) -> FormatOption | None:
     for target in (2160, 1080):
         match = next((opt for opt in options if _matches_quality(opt, target)), None)
@@ -259,16 +314,7 @@ def _select_preferred_va_option(options: list[FormatOption]) -> FormatOption | N
 
 
 def _format_size_localized(nbytes: int | None, lang: str) -> str:
-    text = human_size(nbytes or 0)
-    if lang == "en":
-        return (
-            text.replace("Б", "B")
-            .replace("К", "K")
-            .replace("М", "M")
-            .replace("Г", "G")
-            .replace("Т", "T")
-        )
-    return text
+    return human_size(nbytes or 0, lang)
 
 
 def _quality_label(opt: FormatOption, lang: str) -> str:
@@ -276,12 +322,12 @@ def _quality_label(opt: FormatOption, lang: str) -> str:
         return f"{int(opt.height)}p"
     quality = str(opt.quality or "").strip()
     if quality.lower() == "best":
-        return t(lang, "quality_best_short")
+        return _tc(lang, "quality_best_short")
     if quality:
         return quality
     if opt.label:
         return opt.label[:16]
-    return t(lang, "quality_unknown")
+    return _tc(lang, "quality_unknown")
 
 
 def _format_option_label(
@@ -293,10 +339,11 @@ def _format_option_label(
 ) -> str:
     size = _format_size_localized(opt.est_size, lang)
     quality = _quality_label(opt, lang)
+    unknown = _tc(lang, "quality_unknown")
     if mode == "recommended" and tag in {"best", "compact", "audio", "video"}:
-        base = t(lang, f"opt_{tag}")
+        base = _tc(lang, f"opt_{tag}")
         parts: list[str] = []
-        if tag != "audio" and quality not in {"", t(lang, "quality_unknown"), t(lang, "quality_best_short")}:
+        if tag != "audio" and quality and quality != unknown and quality != _tc(lang, "quality_best_short"):
             parts.append(quality)
         if size != "?":
             parts.append(f"~{size}")
@@ -306,7 +353,7 @@ def _format_option_label(
         return f"{base} · {suffix}" if suffix else base
     icon = {"va": "🎥", "v": "🎬", "a": "🎵"}.get(opt.kind, "📦")
     parts: list[str] = []
-    if quality and quality != t(lang, "quality_unknown"):
+    if quality and quality != unknown:
         parts.append(quality)
     if opt.ext:
         parts.append(opt.ext.upper())
@@ -315,43 +362,48 @@ def _format_option_label(
     return f"{icon} {' • '.join(parts) if parts else quality or icon}"[:64]
 
 
-def _pick_recommended_options(options: list[FormatOption]) -> list[tuple[str, FormatOption]]:
-    pool = _dedupe_options(options)
+def _pick_recommended_options(pool: list[FormatOption]) -> list[tuple[str, FormatOption]]:
     recommended: list[tuple[str, FormatOption]] = []
-    va_opts = [o for o in pool if o.kind == "va"]
-    v_opts = [o for o in pool if o.kind == "v"]
-    a_opts = [o for o in pool if o.kind == "a"]
+    # Один проход по пулу: из v/a нужны только первые опции
+    va_opts: list[FormatOption] = []
+    v_opts: list[FormatOption] = []
+    a_opts: list[FormatOption] = []
+    for o in pool:
+        if o.kind == "va":
+            va_opts.append(o)
+        elif o.kind == "v":
+            if not v_opts:
+                v_opts.append(o)
+        elif o.kind == "a":
+            if not a_opts:
+                a_opts.append(o)
 
     used: set[tuple[str, str]] = set()
 
     if va_opts:
         preferred = _select_preferred_va_option(va_opts)
-        va_sorted = sorted(va_opts, key=_quality_value, reverse=True)
-        if preferred is None and va_sorted:
-            preferred = va_sorted[0]
+        if preferred is None:
+            preferred = va_opts[0]
         if preferred:
             recommended.append(("best", preferred))
             used.add((preferred.kind, preferred.quality))
-        sized = sorted(va_sorted, key=lambda o: o.est_size or 10**12)
+        sized = sorted(va_opts, key=lambda o: o.est_size or 10**12)
         compact_pick = next((opt for opt in sized if (opt.kind, opt.quality) not in used), None)
         if compact_pick:
             recommended.append(("compact", compact_pick))
             used.add((compact_pick.kind, compact_pick.quality))
     elif v_opts:
-        v_sorted = sorted(v_opts, key=_quality_value, reverse=True)
-        recommended.append(("video", v_sorted[0]))
-        used.add((v_sorted[0].kind, v_sorted[0].quality))
+        recommended.append(("video", v_opts[0]))
+        used.add((v_opts[0].kind, v_opts[0].quality))
 
     if a_opts:
-        a_sorted = sorted(a_opts, key=_quality_value, reverse=True)
-        audio_pick = a_sorted[0]
+        audio_pick = a_opts[0]
         if (audio_pick.kind, audio_pick.quality) not in used:
             recommended.append(("audio", audio_pick))
             used.add((audio_pick.kind, audio_pick.quality))
 
     if len(recommended) < 2 and v_opts:
-        v_sorted = sorted(v_opts, key=_quality_value, reverse=True)
-        pick = v_sorted[0]
+        pick = v_opts[0]
         if (pick.kind, pick.quality) not in used:
             recommended.append(("video", pick))
             used.add((pick.kind, pick.quality))
@@ -365,24 +417,26 @@ def _build_recommend_keyboard(
     lang: str,
     url: str,
 ) -> InlineKeyboardMarkup:
+    # options уже подготовлены _prepare_options при сохранении в payload
     rows: list[list[InlineKeyboardButton]] = []
+    prefix = f"fmt|{token}|"
     for tag, opt in _pick_recommended_options(options):
         label = _format_option_label(opt, lang, mode="recommended", tag=tag)
         rows.append(
             [
                 InlineKeyboardButton(
                     text=label[:64],
-                    callback_data=f"fmt|{token}|{opt.kind}|{opt.quality}",
+                    callback_data=prefix + opt.kind + "|" + opt.quality,
                 )
             ]
         )
 
-    if len(_dedupe_options(options)) > len(rows):
+    if len(options) > len(rows):
         rows.append([
-            InlineKeyboardButton(text=t(lang, "menu_more"), callback_data=f"menu|{token}|more")
+            InlineKeyboardButton(text=_tc(lang, "menu_more"), callback_data=f"menu|{token}|more")
         ])
 
-    rows.append([InlineKeyboardButton(text=t(lang, "original"), url=url)])
+    rows.append([InlineKeyboardButton(text=_tc(lang, "original"), url=url)])
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
@@ -393,8 +447,9 @@ def _build_full_keyboard(
     url: str,
 ) -> InlineKeyboardMarkup:
     rows: list[list[InlineKeyboardButton]] = []
+    prefix = f"fmt|{token}|"
     grouped = {"va": [], "v": [], "a": []}
-    for opt in _dedupe_options(options):
+    for opt in options:
         grouped.setdefault(opt.kind, []).append(opt)
 
     for kind in ("va", "v", "a"):
@@ -402,12 +457,12 @@ def _build_full_keyboard(
         opts = grouped.get(kind) or []
         if not opts:
             continue
-        for opt in sorted(opts, key=_quality_value, reverse=True):
-            label = _format_option_label(opt, lang, mode="full")
+        for opt in opts:
+            # _format_option_label в режиме full уже обрезает подпись до 64 символов
             chunk.append(
                 InlineKeyboardButton(
-                    text=label[:64],
-                    callback_data=f"fmt|{token}|{opt.kind}|{opt.quality}",
+                    text=_format_option_label(opt, lang, mode="full"),
+                    callback_data=prefix + opt.kind + "|" + opt.quality,
                 )
             )
             if len(chunk) == 2:
@@ -416,27 +471,48 @@ def _build_full_keyboard(
         if chunk:
             rows.append(chunk)
 
-    rows.append([InlineKeyboardButton(text=t(lang, "menu_back"), callback_data=f"menu|{token}|back")])
-    rows.append([InlineKeyboardButton(text=t(lang, "original"), url=url)])
+    rows.append([InlineKeyboardButton(text=_tc(lang, "menu_back"), callback_data=f"menu|{token}|back")])
+    rows.append([InlineKeyboardButton(text=_tc(lang, "original"), url=url)])
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
+@lru_cache(maxsize=32)
+def _menu_footer(lang: str, mode: str) -> str:
+    head = _tc(lang, "menu_full") if mode == "full" else _tc(lang, "menu_recommended")
+    return "\n".join(part for part in (head, _tc(lang, "menu_hint")) if part)
+
+
 def _render_menu_text(payload: dict[str, object], lang: str, *, mode: str) -> str:
-    title = str(payload.get("title") or "")
+    title = payload.get("title")
     duration = payload.get("duration")
+    has_duration = isinstance(duration, (int, float)) and duration > 0
+    if not title and not has_duration:
+        return _menu_footer(lang, mode)
     parts: list[str] = []
     if title:
-        parts.append(f"<b>{html_escape(title)}</b>")
-    if isinstance(duration, (int, float)) and duration > 0:
+        parts.append(f"<b>{html_escape(str(title))}</b>")
+    if has_duration:
         parts.append(t(lang, "meta_duration", value=human_time(duration)))
-    if parts:
-        parts.append("")
-    if mode == "full":
-        parts.append(t(lang, "menu_full"))
-    else:
-        parts.append(t(lang, "menu_recommended"))
-    parts.append(t(lang, "menu_hint"))
-    return "\n".join(part for part in parts if part)
+    parts.append(_menu_footer(lang, mode))
+    return "\n".join(parts)
+
+
+def _cached_menu(
+    payload: dict[str, object],
+    token: str,
+    options: list[FormatOption],
+    lang: str,
+    url: str,
+    mode: str,
+) -> tuple[str, InlineKeyboardMarkup]:
+    # Меню зависит только от payload, языка и режима: при переключениях «ещё/назад» собираем его один раз
+    menus = payload.setdefault("menus", {})
+    key = (mode, lang)
+    menu = menus.get(key)
+    if menu is None:
+        build = _build_full_keyboard if mode == "full" else _build_recommend_keyboard
+        menu = menus[key] = (_render_menu_text(payload, lang, mode=mode), build(token, options, lang, url))
+    return menu
 
 
 async def _edit_menu_message(message: Message | None, text: str, kb: InlineKeyboardMarkup) -> None:
@@ -456,33 +532,19 @@ async def _edit_menu_message(message: Message | None, text: str, kb: InlineKeybo
             await message.edit_reply_markup(reply_markup=kb)
 
 
-def _make_progress_editor(wait_msg: Message):
-    loop = asyncio.get_running_loop()
-    state = {"pct": -5.0, "ts": 0.0}
-
-    async def _edit(text: str, status: str, pct: float | None) -> None:
-        now = loop.time()
-        last_pct = state["pct"]
-        last_ts = state["ts"]
-        should_update = True
-        if status in {"downloading", "uploading"}:
-            if pct is None:
-                should_update = (now - last_ts) >= 1.0
-            else:
-                should_update = pct >= 99.0 or (pct - last_pct) >= 2.0 or (now - last_ts) >= 1.0
-        elif status == "finished":
-            should_update = True
-        else:
-            should_update = (now - last_ts) >= 1.0
-        if not should_update:
-            return
-        state["ts"] = now
-        if pct is not None:
-            state["pct"] = pct
-        with suppress(Exception):
-            await wait_msg.edit_text(text)
-
-    return _edit
+async def _broadcast_job(job: DownloadJob, render: Callable[[str], str]) -> None:
+    # Текст рендерим один раз на язык; слушателям с тем же текстом правку не шлём
+    texts: dict[str, str] = {}
+    tasks = []
+    # Внутри цикла нет await, поэтому список не может измениться — копия не нужна
+    for listener in job.listeners:
+        text = texts.get(listener.lang)
+        if text is None:
+            text = texts[listener.lang] = render(listener.lang)
+        if text != listener.last_text:
+            tasks.append(listener.send(text))
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
 
 
 def _queue_hint(lang: str) -> str:
@@ -494,29 +556,48 @@ def _queue_hint(lang: str) -> str:
     return f" · {active} in progress"
 
 
-def _get_cached_delivery(key: tuple[int, str, str, str]) -> DeliveryCacheEntry | None:
+def _get_cached_delivery(job_key: tuple[int, str, str, str]) -> DeliveryCacheEntry | None:
+    key = job_key[1:]
     entry = _DELIVERY_CACHE.get(key)
     if not entry:
         return None
     if entry.expires_at <= time.time():
         _DELIVERY_CACHE.pop(key, None)
         return None
+    _DELIVERY_CACHE.move_to_end(key)
     return entry
 
 
+def _put_cached_delivery(job_key: tuple[int, str, str, str], entry: DeliveryCacheEntry) -> None:
+    global _cache_stores
+    key = job_key[1:]
+    _DELIVERY_CACHE[key] = entry
+    _DELIVERY_CACHE.move_to_end(key)
+    _cache_stores += 1
+    if _cache_stores % _CACHE_SWEEP_EVERY == 0:
+        now = time.time()
+        for stale in [k for k, e in _DELIVERY_CACHE.items() if e.expires_at <= now]:
+            del _DELIVERY_CACHE[stale]
+    while len(_DELIVERY_CACHE) > _MAX_CACHE_ENTRIES:
+        _DELIVERY_CACHE.popitem(last=False)
+
+
 def _store_file_delivery(
     key: tuple[int, str, str, str],
     kind: str,
     file_id: str,
     caption: str | None,
 ) -> None:
-    _DELIVERY_CACHE[key] = DeliveryCacheEntry(
-        mode="bot_file",
-        kind=kind,
-        file_id=file_id,
-        caption=caption,
-        direct_url=None,
-        expires_at=time.time() + _CACHE_TTL_SECONDS,
+    _put_cached_delivery(
+        key,
+        DeliveryCacheEntry(
+            mode="bot_file",
+            kind=kind,
+            file_id=file_id,
+            caption=caption,
+            direct_url=None,
+            expires_at=time.time() + _CACHE_TTL_SECONDS,
+        ),
     )
 
 
@@ -525,53 +606,64 @@ def _store_link_delivery(
     direct_url: str,
     caption: str | None,
 ) -> None:
-    _DELIVERY_CACHE[key] = DeliveryCacheEntry(
-        mode="direct_link",
-        kind=None,
-        file_id=None,
-        caption=caption,
-        direct_url=direct_url,
-        expires_at=time.time() + _CACHE_TTL_SECONDS,
+    _put_cached_delivery(
+        key,
+        DeliveryCacheEntry(
+            mode="direct_link",
+            kind=None,
+            file_id=None,
+            caption=caption,
+            direct_url=direct_url,
+            expires_at=time.time() + _CACHE_TTL_SECONDS,
+        ),
     )
 
 
+def _download_done(fut: asyncio.Task) -> None:
+    _ACTIVE_DOWNLOADS.discard(fut)
+    if fut.cancelled():
+        return
+    try:
+        exc = fut.exception()
+    except Exception as err:  # pragma: no cover - defensive
+        logging.exception("download task exception read failed: %s", err)
+        return
+    if exc:
+        logging.exception("download task failed", exc_info=exc)
+
+
+def _drop_job(key: tuple[int, str, str, str], _: asyncio.Task) -> None:
+    _ACTIVE_JOBS.pop(key, None)
+    chat_id = key[0]
+    if not any(k[0] == chat_id for k in _ACTIVE_JOBS):
+        _EDIT_LIMITER.forget(chat_id)
+
+
 def _track_task(task: asyncio.Task) -> None:
+    # Общий колбэк уровня модуля вместо замыкания на каждую задачу
     _ACTIVE_DOWNLOADS.add(task)
+    task.add_done_callback(_download_done)
 
-    def _cleanup(fut: asyncio.Task) -> None:
-        _ACTIVE_DOWNLOADS.discard(fut)
-        if fut.cancelled():
-            return
-        try:
-            exc = fut.exception()
-        except Exception as err:  # pragma: no cover - defensive
-            logging.exception("download task exception read failed: %s", err)
-            return
-        if exc:
-            logging.exception("download task failed", exc_info=exc)
 
-    task.add_done_callback(_cleanup)
+# Метод отправки по типу медиа; всё остальное уходит документом
+_SEND_METHODS = {"image": "answer_photo", "audio": "answer_audio", "video": "answer_video"}
+
+
+def _send_media(message: Message, kind: str, media: str | FSInputFile, caption: str | None) -> Awaitable[Message]:
+    # aiogram принимает file_id строкой и FSInputFile одинаково
+    send = getattr(message, _SEND_METHODS.get(kind, "answer_document"))
+    return send(media, caption=caption or None)
 
 
 async def _send_cached_file(message: Message, kind: str, file_id: str, caption: str | None) -> None:
-    caption = caption or None
-    if kind == "image":
-        await message.answer_photo(file_id, caption=caption)
-        return
-    if kind == "audio":
-        await message.answer_audio(file_id, caption=caption)
-        return
-    if kind == "video":
-        await message.answer_video(file_id, caption=caption)
-        return
-    await message.answer_document(file_id, caption=caption)
+    await _send_media(message, kind, file_id, caption)
 
 
 async def _deliver_from_cache(listener: DownloadListener, entry: DeliveryCacheEntry) -> None:
     try:
         if entry.mode == "bot_file" and entry.file_id:
             await _send_cached_file(listener.origin_message, entry.kind or "document", entry.file_id, entry.caption)
-            await listener.edit_progress(t(listener.lang, "delivered"), "finished", 100.0)
+            await listener.send(t(listener.lang, "delivered"))
             return
         if entry.mode == "direct_link" and entry.direct_url:
             caption = entry.caption or ""
@@ -583,15 +675,16 @@ async def _deliver_from_cache(listener: DownloadListener, entry: DeliveryCacheEn
                 inline_keyboard=[[InlineKeyboardButton(text=t(listener.lang, "original"), url=entry.direct_url)]]
             )
             with suppress(Exception):
-                await listener.wait_msg.edit_text(
+                await _edit_message(
+                    listener.wait_msg,
                     text,
                     reply_markup=kb,
                     link_preview_options=LinkPreviewOptions(is_disabled=True),
                 )
             return
-        await listener.edit_progress(t(listener.lang, "error_download"), "error", None)
+        await listener.send(t(listener.lang, "error_download"))
     except Exception:
-        await listener.edit_progress(t(listener.lang, "error_download"), "error", None)
+        await listener.send(t(listener.lang, "error_download"))
 
 
 def _extract_file_id(kind: str | None, msg: Message) -> str | None:
@@ -614,7 +707,7 @@ def _extract_file_id(kind: str | None, msg: Message) -> str | None:
     return None
 
 
-def _schedule_download(
+async def _schedule_download(
     origin_message: Message,
     wait_msg: Message,
     url: str,
@@ -623,66 +716,45 @@ def _schedule_download(
     lang: str,
 ) -> None:
     key = (origin_message.chat.id, url, kind, quality)
+    # wait_msg только что отправлен с текстом очереди — совпадающую правку send() пропустит
     listener = DownloadListener(
         origin_message=origin_message,
         wait_msg=wait_msg,
         lang=lang,
-        edit_progress=_make_progress_editor(wait_msg),
+        last_text=wait_msg.text,
     )
 
-    async def _reject(reason_key: str) -> None:
-        try:
-            await listener.edit_progress(t(lang, reason_key), "error", None)
-        except Exception:
-            pass
+    # Уже доставленное отдаём по file_id до проверок очереди: скачивание не понадобится
+    cached = _get_cached_delivery(key)
+    if cached:
+        await _deliver_from_cache(listener, cached)
+        return
 
     if key not in _ACTIVE_JOBS:
         if _MAX_ACTIVE_JOBS and len(_ACTIVE_JOBS) >= _MAX_ACTIVE_JOBS:
-            asyncio.create_task(_reject("queue_full"))
+            await listener.send(t(lang, "queue_full"))
             return
         if _MAX_CHAT_JOBS:
             active_for_chat = sum(1 for job in _ACTIVE_JOBS.values() if job.key[0] == origin_message.chat.id)
             if active_for_chat >= _MAX_CHAT_JOBS:
-                asyncio.create_task(_reject("queue_chat_full"))
+                await listener.send(t(lang, "queue_chat_full"))
                 return
 
-    cached = _get_cached_delivery(key)
-    if cached:
-        asyncio.create_task(_deliver_from_cache(listener, cached))
-        return
-
     job = _ACTIVE_JOBS.get(key)
     if job:
         job.listeners.append(listener)
-
-        async def _queued_update() -> None:
-            try:
-                await listener.edit_progress(t(lang, "queued", hint=_queue_hint(lang)), "queued", None)
-            except Exception:
-                pass
-
-        asyncio.create_task(_queued_update())
+        await listener.send(t(lang, "queued", hint=_queue_hint(lang)))
         return
 
+    # Задачу регистрируем до первого await, чтобы параллельный запрос присоединился к ней
     job = DownloadJob(key=key, url=url, kind=kind, quality=quality, listeners=[listener])
     _ACTIVE_JOBS[key] = job
-
-    async def _initial_queue_notice() -> None:
-        try:
-            await listener.edit_progress(t(lang, "queued", hint=_queue_hint(lang)), "queued", None)
-        except Exception:
-            pass
-
-    asyncio.create_task(_initial_queue_notice())
-
+    queued_text = t(lang, "queued", hint=_queue_hint(lang))
     task = asyncio.create_task(_run_download_job(job), name=f"dl:{kind}:{quality}")
     job.task = task
     _track_task(task)
-
-    def _cleanup_job(_: asyncio.Task) -> None:
-        _ACTIVE_JOBS.pop(key, None)
-
-    task.add_done_callback(_cleanup_job)
+    task.add_done_callback(partial(_drop_job, key))
+    await listener.send(queued_text)
 
 
 async def _run_download_job(job: DownloadJob) -> None:
@@ -699,36 +771,31 @@ async def _run_download_job(job: DownloadJob) -> None:
             pct_value = max(0.0, min(100.0, (downloaded / total) * 100.0))
         if final:
             pct_value = 100.0
-        tasks = []
-        bar = progress_bar(pct_value or 0.0)
-        size_s = human_size(downloaded)
-        total_s = human_size(total or 0)
-        spd = f"{human_size(int(speed))}/s" if speed else "—"
-        eta_s = human_time(eta) if eta else "—"
-        for listener in list(job.listeners):
-            lang = listener.lang
+        if not job.should_update(status, pct_value):
+            return
+        # Строки прогресса форматируем только после троттлинга и только для статусов, где они выводятся
+        bar = progress_bar(pct_value or 0.0) if status in {"downloading", "uploading"} else ""
+
+        def render(lang: str) -> str:
+            # Шаблоны берём из кеша _tc и форматируем напрямую: render вызывается на каждом тике прогресса
             if status == "preparing":
-                text = t(lang, "preparing")
+                return _tc(lang, "preparing")
             elif status == "downloading":
-                text = t(
-                    lang,
-                    "downloading",
+                return _tc(lang, "downloading").format(
                     pct=f"{pct_value:.0f}" if pct_value is not None else "?",
                     bar=bar,
-                    size=size_s,
-                    total=total_s,
-                    speed=spd,
-                    eta=eta_s,
+                    size=human_size(downloaded, lang),
+                    total=human_size(total or 0, lang),
+                    speed=f"{human_size(int(speed), lang)}/s" if speed else "—",
+                    eta=human_time(eta) if eta else "—",
                 )
             elif status == "uploading":
-                text = t(lang, "uploading_userbot", pct=int(pct_value or 0), bar=bar)
+                return _tc(lang, "uploading_userbot").format(pct=int(pct_value or 0), bar=bar)
             elif status == "finished":
-                text = t(lang, "download_finished")
-            else:
-                text = "⏳ Обработка…"
-            tasks.append(listener.edit_progress(text, status, pct_value))
-        if tasks:
-            await asyncio.gather(*tasks, return_exceptions=True)
+                return _tc(lang, "download_finished")
+            return "⏳ Обработка…"
+
+        await _broadcast_job(job, render)
 
     await _broadcast("preparing", 0, None, None, None)
 
@@ -756,28 +823,22 @@ async def _run_download_job(job: DownloadJob) -> None:
 
 
 async def _broadcast_error(job: DownloadJob) -> None:
-    tasks = [
-        listener.edit_progress(t(listener.lang, "error_download"), "error", None)
-        for listener in list(job.listeners)
-    ]
-    if tasks:
-        await asyncio.gather(*tasks, return_exceptions=True)
+    await _broadcast_job(job, lambda lang: t(lang, "error_download"))
 
 
 async def _deliver_result(job: DownloadJob, result: DownloadResult) -> None:
-    listeners = list(job.listeners)
+    listeners = tuple(job.listeners)
     if not listeners:
         return
     caption = (result.title or "")[:1024]
     limit_bytes = TELEGRAM_UPLOAD_LIMIT_MB * 1024 * 1024
-    filepath = result.filepath if result.filepath and os.path.exists(result.filepath) else None
+    # Загрузчик заполняет filepath только после проверки файла — повторный stat на loop не нужен
+    filepath = result.filepath
     size = result.filesize or 0
     primary = listeners[0]
 
     async def _mark_all(key: str) -> None:
-        tasks = [listener.edit_progress(t(listener.lang, key), "finished", 100.0) for listener in list(job.listeners)]
-        if tasks:
-            await asyncio.gather(*tasks, return_exceptions=True)
+        await _broadcast_job(job, lambda lang: t(lang, key))
 
     if filepath and size <= limit_bytes:
         sent_msg = await _send_via_bot(primary.origin_message, filepath, result.kind or "document", caption)
@@ -794,20 +855,17 @@ async def _deliver_result(job: DownloadJob, result: DownloadResult) -> None:
         token2 = put_payload({
             "target_chat_id": primary.origin_message.chat.id,
             "caption": caption,
-            "delivery_key": list(job.key),
+            "delivery_key": job.key,
             "kind": result.kind or "document",
         })
         mark = f"UB|{token2}"
         cap2 = (caption + "\n\n" if caption else "") + mark
 
         async def notify(pct: int) -> None:
+            if not job.should_update("uploading", float(pct)):
+                return
             bar = progress_bar(pct)
-            tasks = [
-                listener.edit_progress(t(listener.lang, "uploading_userbot", pct=pct, bar=bar), "uploading", float(pct))
-                for listener in list(job.listeners)
-            ]
-            if tasks:
-                await asyncio.gather(*tasks, return_exceptions=True)
+            await _broadcast_job(job, lambda lang: _tc(lang, "uploading_userbot").format(pct=pct, bar=bar))
 
         ok = await send_file_to_bot(
             me.username or "",
@@ -822,7 +880,7 @@ async def _deliver_result(job: DownloadJob, result: DownloadResult) -> None:
             return
 
     if result.direct_url:
-        for listener in list(job.listeners):
+        for listener in tuple(job.listeners):
             header = t(listener.lang, "delivered_link")
             body = f"{caption}\n" if caption else ""
             direct_label = t(listener.lang, "direct_link")
@@ -831,7 +889,8 @@ async def _deliver_result(job: DownloadJob, result: DownloadResult) -> None:
                 inline_keyboard=[[InlineKeyboardButton(text=t(listener.lang, "original"), url=result.direct_url)]]
             )
             with suppress(Exception):
-                await listener.wait_msg.edit_text(
+                await _edit_message(
+                    listener.wait_msg,
                     text,
                     reply_markup=kb,
                     link_preview_options=LinkPreviewOptions(is_disabled=True),
@@ -929,7 +988,8 @@ async def on_userbot_test(message: Message) -> None:
 
 
 def _extract_url(text: str | None) -> str | None:
-    if not text:
+    # Большинство сообщений без ссылок отсекаем подстрокой, не запуская regex
+    if not text or "http" not in text:
         return None
     m = URL_RE.search(text)
     return m.group(1) if m else None
@@ -964,6 +1024,7 @@ async def on_text_with_url(message: Message) -> None:
         logging.exception("fetch_media_metadata failed: %s", exc)
         basic = BasicInfo(None, None, None, None, None)
         options = []
+    options = _prepare_options(options)
 
     # Предложим выбор по категориям
     if not options:
@@ -971,18 +1032,19 @@ async def on_text_with_url(message: Message) -> None:
         wait_msg = await message.reply("Скачиваю… Пожалуйста, подождите")
         try:
             result = await download_media(url)
-            if result.filepath and os.path.exists(result.filepath):
+            if result.filepath:
                 await _send_via_bot(message, result.filepath, result.kind or "document", (result.title or "")[:1024])
                 await _cleanup_temp(result.filepath)
                 await wait_msg.delete()
                 return
             if result.direct_url:
-                await wait_msg.edit_text(
+                await _edit_message(
+                    wait_msg,
                     ((result.title or "") + "\n" if result.title else "")
                     + f"Прямая ссылка: {result.direct_url}"
                 )
                 return
-            await wait_msg.edit_text("Не удалось скачать файл. Проверьте ссылку.")
+            await _edit_message(wait_msg, "Не удалось скачать файл. Проверьте ссылку.")
             return
         except Exception:
             with suppress(Exception):
@@ -1014,11 +1076,11 @@ async def on_text_with_url(message: Message) -> None:
 async def on_menu_navigation(cb: CallbackQuery) -> None:
     lang = get_user_lang(cb.from_user.id) if cb.from_user else "ru"
     try:
-        parts = (cb.data or "").split("|")
-        if len(parts) != 3:
+        m = MENU_CB_RE.fullmatch(cb.data or "")
+        if not m:
             await cb.answer("Bad", show_alert=True)
             return
-        _, token, action = parts
+        token, action = m.groups()
         payload = get_payload(token)
         if not payload or not payload.get("url"):
             await cb.answer(t(lang, "formats_unavailable"), show_alert=True)
@@ -1026,25 +1088,19 @@ async def on_menu_navigation(cb: CallbackQuery) -> None:
         url = payload["url"]
         options = _options_from_payload(payload.get("options"))
         if not options:
-            options = await probe_media_options(url)
+            options = _prepare_options(await probe_media_options(url))
             if options:
                 payload["options"] = _options_to_payload(options)
+                payload.pop("menus", None)
         if not options:
             await cb.answer(t(lang, "formats_unavailable"), show_alert=True)
             return
 
-        if action == "more":
-            keyboard = _build_full_keyboard(token, options, lang, url)
-            text = _render_menu_text(payload, lang, mode="full")
-        elif action == "back":
-            keyboard = _build_recommend_keyboard(token, options, lang, url)
-            text = _render_menu_text(payload, lang, mode="recommended")
-        else:
-            await cb.answer("Bad", show_alert=True)
-            return
+        mode = "full" if action == "more" else "recommended"
+        text, keyboard = _cached_menu(payload, token, options, lang, url, mode)
 
-        await _edit_menu_message(cb.message, text, keyboard)
-        await cb.answer()
+        # Правка меню и ответ на callback независимы — отправляем параллельно
+        await asyncio.gather(_edit_menu_message(cb.message, text, keyboard), cb.answer())
     except Exception as exc:
         logging.exception("menu navigation failed: %s", exc)
         with suppress(Exception):
@@ -1054,20 +1110,26 @@ async def on_menu_navigation(cb: CallbackQuery) -> None:
 @router.callback_query(F.data.startswith("fmt|"))
 async def on_format_selected(cb: CallbackQuery) -> None:
     try:
-        parts = (cb.data or "").split("|")
-        if len(parts) != 4:
+        m = FMT_CB_RE.fullmatch(cb.data or "")
+        if not m:
             await cb.answer("Некорректный выбор", show_alert=True)
             return
-        _, token, kind, quality = parts
+        token, kind, quality = m.groups()
         payload = get_payload(token)
         if not payload or not payload.get("url"):
             await cb.answer("Истёк срок действия выбора", show_alert=True)
             return
         url = payload["url"]
         lang = get_user_lang(cb.from_user.id) if cb.from_user else "ru"
-        await cb.answer()
-        wait_msg = await cb.message.answer(t(lang, "queued", hint=_queue_hint(lang)))
-        _schedule_download(cb.message, wait_msg, url, kind, quality, lang)
+        # Ответ на callback и сообщение очереди уходят параллельно; сбой answer() не мешает загрузке
+        _, wait_msg = await asyncio.gather(
+            cb.answer(),
+            cb.message.answer(t(lang, "queued", hint=_queue_hint(lang))),
+            return_exceptions=True,
+        )
+        if isinstance(wait_msg, BaseException):
+            raise wait_msg
+        await _schedule_download(cb.message, wait_msg, url, kind, quality, lang)
     except Exception:
         logging.exception("on_format_selected failed")
         with suppress(Exception):
@@ -1077,27 +1139,33 @@ async def on_format_selected(cb: CallbackQuery) -> None:
 @router.callback_query(F.data.startswith("lang|"))
 async def on_lang_switch(cb: CallbackQuery) -> None:
     code = (cb.data or "").split("|", 1)[-1]
-    if cb.from_user:
-        set_user_lang(cb.from_user.id, code)
+    if not cb.from_user:
+        return
+    if code not in {"ru", "en"}:
+        await cb.answer("Bad", show_alert=True)
+        return
+    # Повторный выбор текущего языка: ни записи, ни правки сообщения
+    if get_user_lang(cb.from_user.id) == code:
         await cb.answer("OK")
+        return
+    set_user_lang(cb.from_user.id, code)
+    await cb.answer("OK")
+    with suppress(Exception):
         await cb.message.edit_text(t(code, "settings_saved", lang=("Русский" if code == "ru" else "English")))
 
 
 
 async def _send_via_bot(message: Message, filepath: str, kind: str, caption: str | None) -> Message:
-    if kind == "image":
-        return await message.answer_photo(FSInputFile(filepath), caption=caption or None)
-    if kind == "audio":
-        return await message.answer_audio(FSInputFile(filepath), caption=caption or None)
-    if kind == "video":
-        return await message.answer_video(FSInputFile(filepath), caption=caption or None)
-    return await message.answer_document(FSInputFile(filepath), caption=caption or None)
+    # Файл читается с диска крупными блоками: меньше чтений на один загружаемый файл
+    upload = FSInputFile(filepath, chunk_size=_UPLOAD_CHUNK_SIZE)
+    return await _send_media(message, kind, upload, caption)
 
 
 async def _cleanup_temp(filepath: str) -> None:
     try:
         tmp_dir = Path(filepath).parent
-        shutil.rmtree(tmp_dir, ignore_errors=True)
+        # Для HLS/DASH в каталоге остаются десятки фрагментов — удаляем вне event loop
+        await asyncio.get_running_loop().run_in_executor(_DISK_POOL, shutil.rmtree, tmp_dir, True)
     except Exception:
         pass
 
@@ -1107,6 +1175,9 @@ async def _cleanup_temp(filepath: str) -> None:
 @router.message(F.chat.type == ChatType.PRIVATE)
 async def on_userbot_private_upload(message: Message) -> None:
     cap = message.caption or message.text or ""
+    # Большинство личных сообщений без маркера: отсекаем подстрокой до регулярки
+    if "UB|" not in cap:
+        return
     m = UB_MARK_RE.search(cap)
     if not m:
         return
@@ -1131,24 +1202,16 @@ async def on_userbot_private_upload(message: Message) -> None:
         # ignore errors silently
         pass
     else:
+        # Маркер одноразовый: после пересылки доставку помнит кеш file_id
+        drop_payload(token)
         delivery_key = payload.get("delivery_key")
         kind = str(payload.get("kind") or "document")
-        key_tuple: tuple[int, str, str, str] | None = None
-        if isinstance(delivery_key, (list, tuple)) and len(delivery_key) == 4:
-            try:
-                key_tuple = (
-                    int(delivery_key[0]),
-                    str(delivery_key[1]),
-                    str(delivery_key[2]),
-                    str(delivery_key[3]),
-                )
-            except Exception:
-                key_tuple = None
-        if key_tuple:
+        # Payload живёт в памяти процесса: ключ задачи лежит там готовым кортежем
+        if isinstance(delivery_key, tuple) and len(delivery_key) == 4:
             file_id = _extract_file_id(kind, message)
             if file_id:
                 _store_file_delivery(
-                    key_tuple,
+                    delivery_key,
                     kind,
                     file_id,
                     caption if isinstance(caption, str) else None,
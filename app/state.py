@@ -1,10 +1,13 @@
 import time
 import secrets
+from collections import OrderedDict
 from typing import Any, Dict, Optional
 
 
-_STORE: Dict[str, Dict[str, Any]] = {}
+# Порядок вставки совпадает с порядком ts: просроченные всегда в начале
+_STORE: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
 _TTL_SECONDS = 60 * 30  # 30 минут
+_MAX_ENTRIES = 50_000
 
 # Simple in-memory user preferences (language)
 _USER_LANG: Dict[int, str] = {}
@@ -12,10 +15,15 @@ _USER_LAST_REQ: Dict[int, float] = {}
 
 
 def _cleanup() -> None:
-    now = time.time()
-    to_del = [k for k, v in _STORE.items() if (now - v.get("ts", 0)) > _TTL_SECONDS]
-    for k in to_del:
-        _STORE.pop(k, None)
+    # Снимаем просроченное с головы, а не сканируем всё хранилище на каждый вызов
+    deadline = time.time() - _TTL_SECONDS
+    while _STORE:
+        token, payload = next(iter(_STORE.items()))
+        if payload.get("ts", 0) >= deadline:
+            break
+        del _STORE[token]
+    while len(_STORE) > _MAX_ENTRIES:
+        _STORE.popitem(last=False)
 
 
 def put_payload(payload: Dict[str, Any]) -> str:
@@ -32,6 +40,10 @@ def get_payload(token: str) -> Optional[Dict[str, Any]]:
     return _STORE.get(token)
 
 
+def drop_payload(token: str) -> None:
+    _STORE.pop(token, None)
+
+
 def set_user_lang(user_id: int, lang: str) -> None:
     if lang not in {"ru", "en"}:
         return
@@ -1,14 +1,20 @@
-def human_size(nbytes: int | None) -> str:
+_SIZE_UNITS = {
+    "ru": ("Б", "КБ", "МБ", "ГБ", "ТБ"),
+    "en": ("B", "KB", "MB", "GB", "TB"),
+}
+
+
+def human_size(nbytes: int | None, lang: str = "ru") -> str:
     if not nbytes or nbytes < 0:
         return "?"
-    units = ["Б", "КБ", "МБ", "ГБ", "ТБ"]
+    units = _SIZE_UNITS.get(lang) or _SIZE_UNITS["ru"]
     size = float(nbytes)
     for u in units:
         if size < 1024 or u == units[-1]:
             val = f"{size:.1f}".rstrip("0").rstrip(".")
             return f"{val} {u}"
         size /= 1024
-    return f"{nbytes} Б"
+    return f"{nbytes} {units[0]}"
 
 
 def human_time(seconds: float | int | None) -> str:
@@ -0,0 +1,53 @@
+import time
+from collections import OrderedDict
+
+import pytest
+
+from app import handlers
+
+
+@pytest.fixture
+def cache(monkeypatch):
+    store = OrderedDict()
+    monkeypatch.setattr(handlers, "_DELIVERY_CACHE", store)
+    monkeypatch.setattr(handlers, "_MAX_CACHE_ENTRIES", 2)
+    return store
+
+
+def _entry(ttl=60.0):
+    return handlers.DeliveryCacheEntry(
+        mode="bot_file", kind="video", file_id="f", caption=None, direct_url=None, expires_at=time.time() + ttl
+    )
+
+
+def _key(url, chat_id=1):
+    return (chat_id, url, "video", "720")
+
+
+def test_key_ignores_chat(cache):
+    entry = _entry()
+    handlers._put_cached_delivery(_key("u", chat_id=1), entry)
+    assert handlers._get_cached_delivery(_key("u", chat_id=2)) is entry
+
+
+def test_lru_evicts_least_recently_used(cache):
+    handlers._put_cached_delivery(_key("a"), _entry())
+    handlers._put_cached_delivery(_key("b"), _entry())
+    assert handlers._get_cached_delivery(_key("a")) is not None
+    handlers._put_cached_delivery(_key("c"), _entry())
+    assert [k[0] for k in cache] == ["a", "c"]
+    assert handlers._get_cached_delivery(_key("b")) is None
+
+
+def test_expired_entry_is_dropped(cache):
+    handlers._put_cached_delivery(_key("a"), _entry(ttl=-1))
+    assert handlers._get_cached_delivery(_key("a")) is None
+    assert not cache
+
+
+def test_sweep_removes_expired_entries(cache, monkeypatch):
+    monkeypatch.setattr(handlers, "_MAX_CACHE_ENTRIES", 10)
+    monkeypatch.setattr(handlers, "_CACHE_SWEEP_EVERY", 1)
+    handlers._put_cached_delivery(_key("old"), _entry(ttl=-1))
+    handlers._put_cached_delivery(_key("new"), _entry())
+    assert [k[0] for k in cache] == ["new"]
@@ -0,0 +1,58 @@
+import pytest
+
+from app import config
+
+
+@pytest.fixture
+def env(monkeypatch):
+    target: dict[str, str] = {}
+    monkeypatch.setattr(config, "_ENV", target)
+    return target
+
+
+def _load(tmp_path, text):
+    path = tmp_path / ".env"
+    path.write_text(text, encoding="utf-8")
+    config._fast_load_dotenv(str(path))
+
+
+def test_plain_and_export_lines(tmp_path, env):
+    _load(tmp_path, "A=1\nexport B = two  \n# comment\n\nnot a line\n")
+    assert env == {"A": "1", "B": "two"}
+
+
+def test_inline_comment_needs_whitespace(tmp_path, env):
+    _load(tmp_path, "A=value # note\nB=val#ue\n")
+    assert env == {"A": "value", "B": "val#ue"}
+
+
+def test_quoted_values(tmp_path, env):
+    _load(tmp_path, "A=\"x # y\"\nB='single'\nC=\"\"\n")
+    assert env == {"A": "x # y", "B": "single", "C": ""}
+
+
+def test_quoted_value_followed_by_comment(tmp_path, env):
+    _load(tmp_path, "A=\"quoted\" # trailing\nB='q' #c\n")
+    assert env == {"A": "quoted", "B": "q"}
+
+
+def test_unterminated_quote_is_kept(tmp_path, env):
+    _load(tmp_path, "A=\"open\n")
+    assert env == {"A": "\"open"}
+
+
+def test_crlf_line_endings(tmp_path, env):
+    _load(tmp_path, "A=1\r\nB=\"2\"\r\n")
+    assert env == {"A": "1", "B": "2"}
+
+
+def test_existing_variables_win(tmp_path, env):
+    env["A"] = "from-env"
+    _load(tmp_path, "A=from-file\n")
+    assert env["A"] == "from-env"
+
+
+def test_missing_file_is_ignored(tmp_path, env):
+    config._fast_load_dotenv(str(tmp_path / "absent.env"))
+    config._fast_load_dotenv(None)
+    assert env == {}
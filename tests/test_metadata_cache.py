@@ -0,0 +1,101 @@
+from collections import OrderedDict
+
+import pytest
+
+from app import downloader
+
+
+@pytest.fixture
+def small_cache(monkeypatch):
+    monkeypatch.setattr(downloader, "_metadata_cache", OrderedDict())
+    monkeypatch.setattr(downloader, "_METADATA_CACHE_SIZE", 3)
+    monkeypatch.setattr(downloader, "_METADATA_CACHE_TTL", 60)
+    return downloader._metadata_cache
+
+
+def _put(url):
+    downloader._metadata_cache_set(url, {"id": url}, None)
+
+
+def test_clock_evicts_oldest_unvisited(small_cache):
+    for url in ("a", "b", "c"):
+        _put(url)
+    _put("d")
+    assert list(small_cache) == ["b", "c", "d"]
+
+
+def test_clock_gives_visited_entry_second_chance(small_cache):
+    for url in ("a", "b", "c"):
+        _put(url)
+    assert downloader._metadata_cache_get("a") == ({"id": "a"}, None)
+    _put("d")
+    # «a» ушла в конец со сброшенным флагом, вытеснена следующая — «b»
+    assert list(small_cache) == ["c", "a", "d"]
+    assert small_cache["a"].visited is False
+    _put("e")
+    assert list(small_cache) == ["a", "d", "e"]
+
+
+def test_expired_entry_is_dropped_on_get(small_cache):
+    downloader._metadata_cache_set("a", {"id": "a"}, None, ttl=-1)
+    assert downloader._metadata_cache_get("a") is None
+    assert "a" not in small_cache
+
+
+class _Clock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clk = _Clock(1_000_000.0)
+    monkeypatch.setattr(downloader.time, "time", clk)
+    return clk
+
+
+def _rows(cache):
+    return [r[0] for r in cache._conn.execute("SELECT url FROM kv ORDER BY ts")]
+
+
+def test_disk_cache_roundtrip_and_remaining_ttl(tmp_path, clock):
+    cache = downloader._DiskMetadataCache(str(tmp_path / "meta.db"), ttl=100, max_rows=10)
+    cache.set("u", {"title": "T"}, None)
+    clock.now += 30
+    value, remaining = cache.get("u")
+    assert value == ({"title": "T"}, None)
+    assert remaining == pytest.approx(70)
+    clock.now += 71
+    assert cache.get("u") is None
+
+
+def test_disk_cache_keeps_errors(tmp_path, clock):
+    cache = downloader._DiskMetadataCache(str(tmp_path / "meta.db"), ttl=100, max_rows=10)
+    cache.set("u", None, "boom")
+    assert cache.get("u")[0] == (None, "boom")
+
+
+def test_disk_cache_prunes_expired_and_extra_rows(tmp_path, clock, monkeypatch):
+    monkeypatch.setattr(downloader._DiskMetadataCache, "_PRUNE_EVERY", 4)
+    cache = downloader._DiskMetadataCache(str(tmp_path / "meta.db"), ttl=100, max_rows=2)
+    cache.set("old", {}, None)
+    clock.now += 150
+    for url in ("a", "b", "c"):
+        clock.now += 1
+        cache.set(url, {}, None)
+    # Четвёртая запись запускает чистку: «old» просрочена, из свежих остаются две новейшие
+    assert _rows(cache) == ["b", "c"]
+
+
+def test_disk_cache_prunes_on_open(tmp_path, clock):
+    path = str(tmp_path / "meta.db")
+    cache = downloader._DiskMetadataCache(path, ttl=100, max_rows=10)
+    cache.set("old", {}, None)
+    clock.now += 1
+    cache.set("new", {}, None)
+    clock.now += 100
+    reopened = downloader._DiskMetadataCache(path, ttl=100, max_rows=10)
+    assert _rows(reopened) == ["new"]
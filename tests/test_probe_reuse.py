@@ -0,0 +1,92 @@
+import copy
+
+import yt_dlp
+
+from app import downloader
+
+
+def _raw_info() -> dict:
+    return {
+        "id": "vid",
+        "title": "Clip",
+        "extractor": "generic",
+        "extractor_key": "Generic",
+        "webpage_url": "https://example.com/watch",
+        "duration": 10,
+        "formats": [
+            {
+                "format_id": "a1",
+                "url": "https://example.com/a1.m4a",
+                "ext": "m4a",
+                "vcodec": "none",
+                "acodec": "mp4a.40.2",
+                "abr": 128,
+                "protocol": "https",
+            },
+            {
+                "format_id": "v1",
+                "url": "https://example.com/v1.mp4",
+                "ext": "mp4",
+                "vcodec": "avc1",
+                "acodec": "none",
+                "height": 720,
+                "protocol": "https",
+            },
+        ],
+    }
+
+
+def _probe_info() -> dict:
+    # Как проба: extract_info(download=False) с выбором формата по умолчанию
+    ydl = yt_dlp.YoutubeDL({"quiet": True, "no_warnings": True})
+    return ydl.process_ie_result(_raw_info(), download=False)
+
+
+def _selected(selector: str, info: dict) -> list:
+    seen = []
+    ydl = yt_dlp.YoutubeDL({"quiet": True, "no_warnings": True, "format": selector})
+    ydl.process_info = lambda d: seen.append(copy.deepcopy(d))
+    ydl.process_ie_result(info, download=True)
+    return seen
+
+
+def test_probe_keeps_default_selection():
+    probe = _probe_info()
+    assert [f["format_id"] for f in probe["requested_formats"]] == ["v1", "a1"]
+
+
+def test_audio_selection_drops_probe_requested_formats():
+    seen = _selected("bestaudio", downloader._reprocessable_info(_probe_info()))
+    assert len(seen) == 1
+    assert seen[0]["format_id"] == "a1"
+    assert seen[0].get("requested_formats") is None
+
+
+def test_reprocessable_info_matches_fresh_selection():
+    fresh = _selected("bestvideo", _raw_info())
+    reused = _selected("bestvideo", downloader._reprocessable_info(_probe_info()))
+    assert [d["format_id"] for d in reused] == [d["format_id"] for d in fresh] == ["v1"]
+    assert reused[0].get("requested_formats") is None
+
+
+def test_reprocessable_info_does_not_touch_cached_probe():
+    probe = _probe_info()
+    snapshot = copy.deepcopy(probe)
+    downloader._reprocessable_info(probe)
+    assert probe == snapshot
+
+
+def test_single_format_info_is_left_intact():
+    info = {"id": "x", "title": "t", "url": "https://example.com/x.jpg", "ext": "jpg"}
+    assert downloader._reprocessable_info(info) == info
+
+
+def test_size_capped_selector_applies_to_reused_probe():
+    # Селектор download_media: подходит только аудио, лучшая пара пробы в лимит не влезает
+    probe = _probe_info()
+    for f in probe["formats"]:
+        f["filesize"] = 5 << 20 if f["format_id"] == "a1" else 500 << 20
+    selector = "bestvideo[filesize<=?50M]+bestaudio[filesize<=?50M]/best[filesize<=?50M]/bestaudio[filesize<=?50M]"
+    seen = _selected(selector, downloader._reprocessable_info(probe))
+    assert [d["format_id"] for d in seen] == ["a1"]
+    assert seen[0].get("requested_formats") is None